@@ -2,10 +2,9 @@
 from rdkit import rdBase
 rdBase.DisableLog('rdApp.*')
 import numpy as np
-import nltk
 import copy
-from smiles_grammar_inorganic import GCFG
 from cfg_util import *
+from smiles_validation import smiles_error
 
 def mutation(gene):
     idx = np.random.choice(len(gene))
@@ -14,6 +13,82 @@ def mutation(gene):
     return gene_mutant
 
 
+def mutation_outcomes(gene, grammar=None, n_codon_values=256, close_rings=False, complete=False, codon_table=None,
+                      valence=False):
+    # Exact distribution of the SMILES produced by mutation() on this gene, as {smiles: probability}:
+    # a uniform position and a uniform codon value, so n_codon_values // n_choices (+1) values select each choice
+    # (or codon_table.n_codons of them with a CodonTable).
+    # The decoded parent collects the mutations that keep the production (or fall after the derivation)
+    # Exact, not fast: every distinct outcome is decoded, which costs more than decoding a sample of mutants
+    grammar = get_grammar(grammar)
+    tree = decode_tree(gene, grammar=grammar, complete=complete, codon_table=codon_table, valence=valence)
+    parent = tree.smiles
+    if close_rings:
+        parent = decode(gene_to_cfg(gene, grammar=grammar, close_rings=True, complete=complete,
+                                    codon_table=codon_table, valence=valence), grammar=grammar)
+    outcomes = {}
+    changed = 0.0
+    for smiles, keys in neighbours(gene, grammar=grammar, close_rings=close_rings, complete=complete,
+                                   codon_table=codon_table, valence=valence).items():
+        p = 0.0
+        for position, choice in keys:
+            lhs = grammar.lhs_ids[tree.rules[position]]
+            if codon_table is not None:
+                p += codon_table.n_codons[codon_table.rule(lhs, choice)] / (codon_table.n_values * len(gene))
+                continue
+            n_choices = grammar.choice_offsets[lhs + 1] - grammar.choice_offsets[lhs]
+            p += (n_codon_values // n_choices + (choice < n_codon_values % n_choices)) / (n_codon_values * len(gene))
+        outcomes[smiles] = outcomes.get(smiles, 0.0) + p
+        changed += p
+    outcomes[parent] = outcomes.get(parent, 0.0) + 1.0 - changed
+    return outcomes
+
+
+def subtree_spans(gene, grammar=None, codon_table=None):
+    # Decode the gene once: the lhs nonterminal of every codon used by the derivation and the end
+    # (exclusive) of the subtree it starts. Returns None if the gene does not complete its derivation
+    grammar = get_grammar(grammar)
+    tree = decode_tree(gene, grammar=grammar, codon_table=codon_table)
+    if not tree.complete:
+        return None
+    return [grammar.lhs_ids[r] for r in tree.rules], tree.end
+
+
+def crossover(p_gene_a, p_gene_b, symbols=None, grammar=None, max_len=None, codon_table=None):
+    # Subtree crossover: a random subtree of parent a is replaced by a subtree of parent b rooted at the same
+    # nonterminal, e.g. a 'ligand', a 'branch' or a 'metal_symbol'. Codons inside a subtree only depend on its
+    # root, so the child decodes to parent a with that subtree swapped.
+    # symbols restricts the crossover points to these nonterminals. The child is the spliced gene, whose length
+    # follows the swapped subtrees; with max_len it is padded with random codons or truncated to that length
+    grammar = get_grammar(grammar)
+    spans_a = subtree_spans(p_gene_a, grammar, codon_table)
+    spans_b = subtree_spans(p_gene_b, grammar, codon_table)
+    if spans_a is None or spans_b is None:
+        return list(p_gene_a)
+    lhs_a, end_a = spans_a
+    lhs_b, end_b = spans_b
+    allowed = None if symbols is None else {grammar.nonterminal_id[symbol] for symbol in symbols}
+
+    # The root is skipped, swapping it would just copy parent b
+    positions_b = {}
+    for j in range(1, len(lhs_b)):
+        positions_b.setdefault(lhs_b[j], []).append(j)
+    candidates = [i for i in range(1, len(lhs_a)) if lhs_a[i] in positions_b
+                  and (allowed is None or lhs_a[i] in allowed)]
+    if not candidates:
+        return list(p_gene_a)
+
+    i = candidates[np.random.randint(len(candidates))]
+    options = positions_b[lhs_a[i]]
+    j = options[np.random.randint(len(options))]
+    child = list(p_gene_a[:i]) + list(p_gene_b[j:end_b[j]]) + list(p_gene_a[end_a[i]:])
+    if max_len is None:
+        return child
+    if len(child) > max_len:
+        return child[:max_len]
+    return child + [np.random.randint(0, 256) for _ in range(max_len - len(child))]
+
+
 def deduplicate(population):
     unique_smiles = set()
     unique_population = []
@@ -25,12 +100,17 @@ def deduplicate(population):
     return unique_population
 
 
-def mutate(p_gene):
+def mutate(p_gene, close_rings=False, complete=False, codon_table=None, valence=False, cache=None):
+    # cache: a DecodeCache, mutants with the same effective gene as an earlier one are not decoded again
     c_gene = mutation(p_gene)
     try:
         # Decode the mutated gene into SMILES directly without RDKit canonicalization
         # (Devation from original Guacamol code)
-        c_smiles = decode(gene_to_cfg(c_gene))
+        c_smiles = decode_gene(c_gene, cache=cache, close_rings=close_rings, complete=complete,
+                               codon_table=codon_table, valence=valence)
+        # Structurally broken SMILES are discarded before any toolkit sees them
+        if c_smiles and smiles_error(c_smiles) is not None:
+            c_smiles = ''
         
     except Exception as e:
         # Handle any decoding errors gracefully
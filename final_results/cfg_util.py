@@ -1,14 +1,22 @@
-import nltk
+import array
+import bisect
+import json
+import time
+from collections import OrderedDict
 
-import nltk.parse.chart
-import numpy as np
+from grammar_tables import GrammarTables, get_grammar, register_grammar
+from smiles_validation import DONOR_CHARGE, max_bonds
 
-from smiles_grammar_inorganic import GCFG
+# Every function takes the grammar as a registered name ('inorganic', 'organic') or a compiled GrammarTables,
+# None meaning the inorganic grammar. Grammars are loaded from small cached tables;
+# nltk is only imported by encode (chart parsing) and numpy only where arrays or random codons are needed
 
 
 def get_smiles_tokenizer(cfg):
-    long_tokens = [a for a in cfg._lexical_index.keys() if len(a) > 1]
-    # there are currently 6 double letter entities in the grammar (7 with a new metal)
+    # cfg is either an nltk CFG or GrammarTables
+    lexical_tokens = cfg.terminals if isinstance(cfg, GrammarTables) else list(cfg._lexical_index.keys())
+    long_tokens = [a for a in lexical_tokens if len(a) > 1]
+    # there are currently 88 multi-letter entities in the inorganic grammar (6 in the organic one)
     # these are their replacement, with no particular meaning
     # they need to be ascii and not part of the SMILES symbol vocabulary
     # replacements = ['!', '?', '.', ',', ';', '$', '_'] #(one symbol added)
@@ -28,9 +36,10 @@ def get_smiles_tokenizer(cfg):
     # print(f'Long tokens: {len(long_tokens)}')
     # # print(f'Long tokens: {long_tokens}')
     # print(f'Replacements: {len(replacements)}')
-    assert len(long_tokens) == len(replacements)
+    assert len(long_tokens) <= len(replacements)
+    replacements = replacements[:len(long_tokens)]
     for token in replacements:
-        assert token not in cfg._lexical_index
+        assert token not in lexical_tokens
 
     def tokenize(smiles):
         for i, token in enumerate(long_tokens):
@@ -47,30 +56,77 @@ def get_smiles_tokenizer(cfg):
     return tokenize
 
 
-def encode(smiles):
-    tokenize = get_smiles_tokenizer(GCFG)
+def grammar_tokenizer(grammar):
+    # The tokenizer only depends on the grammar, build it once per grammar
+    if 'tokenizer' not in grammar.cache:
+        grammar.cache['tokenizer'] = get_smiles_tokenizer(grammar)
+    return grammar.cache['tokenizer']
+
+
+def production_index(grammar):
+    # Map from nltk Production to its index, built once per grammar
+    if 'production_index' not in grammar.cache:
+        grammar.cache['production_index'] = {prod: ix for ix, prod in enumerate(grammar.cfg.productions())}
+    return grammar.cache['production_index']
+
+
+class TimeoutException(Exception):
+    pass
+
+
+class MemoryLimitExceeded(Exception):
+    pass
+
+
+# Approximate memory taken by one chart edge (edge, indexes and child pointers),
+# measured with tracemalloc on the inorganic grammar
+CHART_EDGE_BYTES = 1024
+
+
+def check_budget(steps, max_steps=None, deadline=None):
+    # Cooperative replacement for signal.alarm: called from inside the parsing/decoding loops,
+    # so it works in any thread and never leaves a half-built chart behind
+    if max_steps is not None and steps > max_steps:
+        raise TimeoutException(f'Step budget of {max_steps} exceeded')
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutException('Deadline exceeded')
+
+
+def encode(smiles, max_edges=None, deadline=None, max_memory=None, stats=None, trace_memory=False, grammar=None):
+    # max_edges bounds the size of the chart, deadline is an absolute time.monotonic() value;
+    # TimeoutException is raised when either is exceeded.
+    # max_memory (bytes) bounds the chart memory, MemoryLimitExceeded is raised above it.
+    # If a stats dict is given, it receives the peak chart size ('chart_edges') and bytes ('peak_bytes')
+    import numpy as np
+    from chart_parser import BudgetedChartParser, first_parse_productions
+
+    grammar = get_grammar(grammar)
+    GCFG = grammar.cfg
+    tokenize = grammar_tokenizer(grammar)
     tokens = tokenize(smiles)
-    parser = nltk.ChartParser(GCFG)
+    parser = BudgetedChartParser(GCFG, max_edges=max_edges, deadline=deadline,
+                                 max_memory=max_memory, trace_memory=trace_memory)
     try:
-        parse_tree = parser.parse(tokens).__next__()
-    except StopIteration:
+        chart = parser.chart_parse(tokens)
+    finally:
+        if stats is not None:
+            stats['chart_edges'] = parser.chart_edges
+            stats['peak_bytes'] = parser.peak_bytes
+    productions_seq = first_parse_productions(chart, GCFG, deadline=deadline)
+    if productions_seq is None:
         # print(f'Failed to parse {smiles}')
         return None
-    productions_seq = parse_tree.productions()
     # print(productions_seq)
-    # print(parse_tree.productions())
     # print(f'Length of productions_seq: {len(productions_seq)}')
-    productions = GCFG.productions()
-    prod_map = {}
-    for ix, prod in enumerate(productions):
-        prod_map[prod] = ix
+    prod_map = production_index(grammar)
     indices = np.array([prod_map[prod] for prod in productions_seq], dtype=int)  
     return indices
 
 
-def prods_to_eq(prods):
+def prods_to_eq(prods, max_steps=None, deadline=None):
     seq = [prods[0].lhs()]
-    for prod in prods:
+    for step, prod in enumerate(prods):
+        check_budget(step, max_steps, deadline)
         if str(prod.lhs()) == 'Nothing':
             break
         for ix, s in enumerate(seq):
@@ -82,45 +138,890 @@ def prods_to_eq(prods):
     except Exception:
         return ''
 
-def decode(rule):
-    productions = GCFG.productions()
-    prod_seq = [productions[i] for i in rule]
-    # print(prod_seq)
-    # print(f'Length of prod_seq: {len(prod_seq)}')
-    return prods_to_eq(prod_seq)
-
-def cfg_to_gene(prod_rules, max_len=-1):
-    gene = []
-    for r in prod_rules:
-        lhs = GCFG.productions()[r].lhs()
-        possible_rules = [idx for idx, rule in enumerate(GCFG.productions())
-                          if rule.lhs() == lhs]
-        gene.append(possible_rules.index(r))
+def rules_to_smiles(rule, tables, max_steps=None, deadline=None):
+    # Same leftmost derivation as prods_to_eq, on production indices and the integer grammar tables
+    n_nonterminals = tables.n_nonterminals
+    lhs_ids, rhs_offsets, rhs_symbols = tables.lhs_ids, tables.rhs_offsets, tables.rhs_symbols
+    seq = [lhs_ids[rule[0]]]
+    for step, r in enumerate(rule):
+        check_budget(step, max_steps, deadline)
+        lhs = lhs_ids[r]
+        if lhs == tables.nothing_id:
+            break
+        for ix, symbol in enumerate(seq):
+            if symbol == lhs:
+                seq[ix:ix + 1] = rhs_symbols[rhs_offsets[r]:rhs_offsets[r + 1]]
+                break
+    if any(symbol < n_nonterminals for symbol in seq):
+        return ''
+    return ''.join([tables.symbol_strings[symbol] for symbol in seq])
+
+def decode(rule, max_steps=None, deadline=None, grammar=None):
+    # print(f'Length of rule: {len(rule)}')
+    return rules_to_smiles(rule, get_grammar(grammar), max_steps=max_steps, deadline=deadline)
+
+def cfg_to_gene(prod_rules, max_len=-1, grammar=None, codon_table=None):
+    grammar = get_grammar(grammar)
+    first_codon = grammar.rule_choice if codon_table is None else codon_table.first_codon
+    gene = [first_codon[r] for r in prod_rules]
     if max_len > 0:
         if len(gene) > max_len:
             gene = gene[:max_len]
         else:
+            import numpy as np
             gene = gene + [np.random.randint(0, 256)
                            for _ in range(max_len - len(gene))]
     return gene
 
 
-def gene_to_cfg(gene):
+def gene_to_cfg(gene, max_steps=None, deadline=None, grammar=None, close_rings=False, complete=False,
+                codon_table=None, valence=False):
+    # close_rings: relabel the ring closure digits so that every ring bond is opened and closed
+    # on different atoms where possible (see close_ring_bonds)
+    # complete: when the gene runs out mid-derivation, finish it with the shortest expansion
+    # of every open nonterminal instead of leaving it unfinished (decoded as '')
+    # codon_table: a CodonTable mapping codon values to productions instead of g % n_choices
+    # valence: keep the bonds, hydrogens, ring bonds and branches of every atom within its valence
+    # (see valence_gene_to_cfg)
+    grammar = get_grammar(grammar)
+    prod_rules, stack = gene_to_derivation(gene, grammar, max_steps, deadline, codon_table, valence)
+    return finish_derivation(prod_rules, stack, grammar, close_rings, complete, max_steps, deadline)
+
+
+def gene_to_derivation(gene, grammar, max_steps=None, deadline=None, codon_table=None, valence=False):
+    # Productions selected by the codons of the gene and the stack of nonterminals left open when it runs out
+    if valence:
+        return valence_gene_to_cfg(gene, grammar, max_steps, deadline, codon_table)
+    if codon_table is not None:
+        return codon_table.gene_to_derivation(gene, max_steps, deadline)
     prod_rules = []
-    stack = [GCFG.productions()[0].lhs()]
-    for g in gene:
+    choice_offsets, choice_rules = grammar.choice_offsets, grammar.choice_rules
+    stack_offsets, stack_symbols = grammar.stack_offsets, grammar.stack_symbols
+    stack = [grammar.start_id]
+    for step, g in enumerate(gene):
+        check_budget(step, max_steps, deadline)
         try:
             lhs = stack.pop()
         except Exception:
             break
-        possible_rules = [idx for idx, rule in enumerate(GCFG.productions())
-                          if rule.lhs() == lhs]
-        rule = possible_rules[g % len(possible_rules)]
+        first_rule = choice_offsets[lhs]
+        rule = choice_rules[first_rule + g % (choice_offsets[lhs + 1] - first_rule)]
         prod_rules.append(rule)
-        rhs = filter(lambda a: (type(a) == nltk.grammar.Nonterminal) and (str(a) != 'None'),
-                     GCFG.productions()[rule].rhs())
-        # rhs_list = list(rhs)
-        # rhs_list_reversed = rhs_list[::-1]
-        # stack.extend(rhs_list_reversed)
-        stack.extend(list(rhs)[::-1])   
+        # Nonterminals of the rhs (without 'None'), already reversed in the tables
+        stack.extend(stack_symbols[stack_offsets[rule]:stack_offsets[rule + 1]])
+    return prod_rules, stack
+
+
+def finish_derivation(prod_rules, stack, grammar, close_rings=False, complete=False, max_steps=None, deadline=None):
+    # The complete and close_rings steps of gene_to_cfg, on the output of gene_to_derivation
+    if complete and stack:
+        prod_rules = prod_rules + complete_derivation(stack, grammar, max_steps=max_steps, deadline=deadline)
+    if close_rings:
+        prod_rules = close_ring_bonds(prod_rules, grammar)
+    return prod_rules
+
+
+def derivation_key(prod_rules, grammar):
+    return bytes(grammar.rule_choice[r] for r in prod_rules)
+
+
+def gene_key(gene, grammar=None, max_steps=None, deadline=None, codon_table=None, valence=False):
+    # Canonical effective gene: the choice index of every codon the derivation consumes, as bytes. Genes that
+    # only differ in unused tail codons or in codons selecting the same production share the key, and decode
+    # to the same SMILES (completion and ring closing only depend on these productions)
+    grammar = get_grammar(grammar)
+    prod_rules, _ = gene_to_derivation(gene, grammar, max_steps, deadline, codon_table, valence)
+    return derivation_key(prod_rules, grammar)
+
+
+class DecodeCache:
+    # Bounded least-recently-used map from gene_key to what was derived from the decoded gene
+    # (SMILES, validity...). One cache serves one decoding configuration (grammar, close_rings, complete...)
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+def decode_gene(gene, grammar=None, cache=None, max_steps=None, deadline=None, close_rings=False, complete=False,
+                codon_table=None, valence=False):
+    # decode(gene_to_cfg(gene)), memoised in a DecodeCache when one is given
+    # The gene is derived once: the key comes from its productions, which are then finished and decoded on a miss
+    grammar = get_grammar(grammar)
+    prod_rules, stack = gene_to_derivation(gene, grammar, max_steps, deadline, codon_table, valence)
+    key = derivation_key(prod_rules, grammar) if cache is not None else None
+    smiles = cache.get(key) if cache is not None else None
+    if smiles is None:
+        prod_rules = finish_derivation(prod_rules, stack, grammar, close_rings, complete, max_steps, deadline)
+        smiles = decode(prod_rules, grammar=grammar, max_steps=max_steps, deadline=deadline)
+        if cache is not None:
+            cache.put(key, smiles)
+    return smiles
+
+
+def decode_genes(genes, grammar=None, cache=None, close_rings=False, complete=False, codon_table=None,
+                 valence=False):
+    # decode_gene of a whole population. Plain decoding goes through the compiled kernels of decode_kernel when
+    # numba is installed (cheaper than computing the cache keys), everything else one gene at a time
+    grammar = get_grammar(grammar)
+    if not (close_rings or complete or valence or codon_table is not None):
+        import decode_kernel
+        if decode_kernel.JIT_AVAILABLE:
+            return decode_kernel.decode_population(genes, grammar)
+    return [decode_gene(gene, grammar=grammar, cache=cache, close_rings=close_rings, complete=complete,
+                        codon_table=codon_table, valence=valence) for gene in genes]
+
+
+def complete_derivation(stack, grammar, max_steps=None, deadline=None):
+    # Deterministic completion of a leftmost derivation from its stack of open nonterminals
+    min_rules = grammar.min_rules
+    stack_offsets, stack_symbols = grammar.stack_offsets, grammar.stack_symbols
+    stack = list(stack)
+    prod_rules = []
+    step = 0
+    while stack:
+        check_budget(step, max_steps, deadline)
+        rule = min_rules[stack.pop()]
+        prod_rules.append(rule)
+        stack.extend(stack_symbols[stack_offsets[rule]:stack_offsets[rule + 1]])
+        step += 1
+    return prod_rules
+
+
+def count_productions(encoded_corpus, grammar=None):
+    # How often every production is used in a corpus of encoded SMILES (production index sequences)
+    grammar = get_grammar(grammar)
+    counts = [0] * len(grammar)
+    for prod_rules in encoded_corpus:
+        for r in prod_rules:
+            counts[r] += 1
+    return counts
+
+
+class CodonTable:
+    # Codon values mapped to productions in proportion to weights, e.g. production frequencies of a corpus
+    # from count_productions, instead of g % n_choices which makes every alternative equally likely.
+    # For every nonterminal the n_values codon values are shared among its alternatives by largest remainder,
+    # every alternative keeping at least one value so that no production becomes unreachable
+
+    def __init__(self, weights, grammar=None, n_values=256, pseudocount=1.0):
+        grammar = get_grammar(grammar)
+        self.grammar = grammar
+        self.n_values = n_values
+        self.weights = list(weights)
+        # Production selected by codon value g for nonterminal n: rules[n * n_values + g]
+        self.rules = array.array('i', [-1]) * (grammar.n_nonterminals * n_values)
+        # Number of codon values selecting every production, and the first of them (what cfg_to_gene writes)
+        self.n_codons = array.array('i', [0]) * len(grammar)
+        self.first_codon = array.array('i', [0]) * len(grammar)
+        for n in range(grammar.n_nonterminals):
+            alternatives = grammar.choice_rules[grammar.choice_offsets[n]:grammar.choice_offsets[n + 1]]
+            if not alternatives:
+                continue
+            if len(alternatives) > n_values:
+                raise ValueError(f'{grammar.nonterminals[n]} has more alternatives than codon values')
+            w = [max(self.weights[r], 0) + pseudocount for r in alternatives]
+            spare = n_values - len(alternatives)
+            shares = [spare * x / sum(w) for x in w]
+            sizes = [1 + int(share) for share in shares]
+            by_remainder = sorted(range(len(alternatives)), key=lambda k: int(shares[k]) - shares[k])
+            for k in by_remainder[:n_values - sum(sizes)]:
+                sizes[k] += 1
+            g = 0
+            for r, size in zip(alternatives, sizes):
+                self.n_codons[r] = size
+                self.first_codon[r] = g
+                self.rules[n * n_values + g:n * n_values + g + size] = array.array('i', [r]) * size
+                g += size
+
+    def rule(self, symbol, g):
+        return self.rules[symbol * self.n_values + g % self.n_values]
+
+    def gene_to_cfg(self, gene, max_steps=None, deadline=None, close_rings=False, complete=False):
+        prod_rules, stack = self.gene_to_derivation(gene, max_steps, deadline)
+        return finish_derivation(prod_rules, stack, self.grammar, close_rings, complete, max_steps, deadline)
+
+    def gene_to_derivation(self, gene, max_steps=None, deadline=None):
+        grammar = self.grammar
+        prod_rules = []
+        rules, n_values = self.rules, self.n_values
+        stack_offsets, stack_symbols = grammar.stack_offsets, grammar.stack_symbols
+        stack = [grammar.start_id]
+        for step, g in enumerate(gene):
+            check_budget(step, max_steps, deadline)
+            try:
+                lhs = stack.pop()
+            except Exception:
+                break
+            rule = rules[lhs * n_values + g % n_values]
+            prod_rules.append(rule)
+            stack.extend(stack_symbols[stack_offsets[rule]:stack_offsets[rule + 1]])
+        return prod_rules, stack
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'grammar': self.grammar.name, 'hash': self.grammar.hash, 'n_values': self.n_values,
+                       'weights': self.weights}, f)
+
+    @classmethod
+    def load(cls, path, grammar=None, pseudocount=1.0):
+        with open(path) as f:
+            data = json.load(f)
+        grammar = get_grammar(grammar if grammar is not None else data['grammar'])
+        if data['hash'] != grammar.hash:
+            raise ValueError(f'{path} was learned for another version of the {data["grammar"]} grammar')
+        return cls(data['weights'], grammar, data['n_values'], pseudocount)
+
+
+def neighbours(gene, max_steps=None, deadline=None, grammar=None, complete=False, close_rings=False,
+               codon_table=None, valence=False):
+    # Every single-codon change that selects a different production, as {smiles: [(position, choice), ...]}
+    # where setting gene[position] = choice gives that SMILES ('' for unfinished derivations).
+    # With a codon_table, choice is the first codon value of the production instead of its alternative index.
+    # The stack and the output of the unchanged prefix are shared: the stack is a linked list of
+    # (symbol, rest) cells, so the state before every codon is kept without copying
+    grammar = get_grammar(grammar)
+    n_nonterminals, symbol_strings = grammar.n_nonterminals, grammar.symbol_strings
+    choice_offsets, choice_rules = grammar.choice_offsets, grammar.choice_rules
+    if codon_table is None:
+        def select(symbol, g):
+            first = choice_offsets[symbol]
+            return choice_rules[first + g % (choice_offsets[symbol + 1] - first)]
+    else:
+        select = codon_table.rule
+    rhs_offsets, rhs_symbols, min_rules = grammar.rhs_offsets, grammar.rhs_symbols, grammar.min_rules
+    none_id = grammar.nonterminal_id.get('None', -1)
+
+    def expand(node, rule):
+        for k in range(rhs_offsets[rule + 1] - 1, rhs_offsets[rule] - 1, -1):
+            if rhs_symbols[k] != none_id:
+                node = (rhs_symbols[k], node)
+        return node
+
+    def derive(node, tokens, position, snapshots=None):
+        # Continue the leftmost derivation from a stack, appending the terminals to tokens
+        while node is not None:
+            symbol, rest = node
+            if symbol >= n_nonterminals:
+                tokens.append(symbol_strings[symbol])
+                node = rest
+                continue
+            if position >= len(gene):
+                if not complete:
+                    return False
+                node = expand(rest, min_rules[symbol])
+                continue
+            check_budget(position, max_steps, deadline)
+            if snapshots is not None:
+                snapshots.append((node, len(tokens)))
+            node = expand(rest, select(symbol, gene[position]))
+            position += 1
+        return True
+
+    if valence:
+        # The allowed productions depend on everything decoded before, every mutant is decoded from scratch
+        prod_rules = gene_to_cfg(gene, max_steps=max_steps, deadline=deadline, grammar=grammar,
+                                 codon_table=codon_table, valence=True)
+        snapshots = [((grammar.lhs_ids[rule], None), 0) for rule in prod_rules[:len(gene)]]
+    else:
+        snapshots = []
+        base_tokens = []
+        derive((grammar.start_id, None), base_tokens, 0, snapshots)
+
+    results = {}
+    for position, (node, n_tokens) in enumerate(snapshots):
+        symbol, rest = node
+        current = select(symbol, gene[position])
+        for alternative in range(choice_offsets[symbol], choice_offsets[symbol + 1]):
+            rule = choice_rules[alternative]
+            if rule == current:
+                continue
+            choice = alternative - choice_offsets[symbol] if codon_table is None else codon_table.first_codon[rule]
+            if close_rings or valence:
+                # Ring closures and valences depend on the whole derivation, decode the mutant from scratch
+                mutant = list(gene)
+                mutant[position] = choice
+                smiles = decode(gene_to_cfg(mutant, max_steps=max_steps, deadline=deadline, grammar=grammar,
+                                            close_rings=close_rings, complete=complete, codon_table=codon_table,
+                                            valence=valence), grammar=grammar)
+            else:
+                tokens = base_tokens[:n_tokens]
+                finished = derive(expand(rest, rule), tokens, position + 1)
+                smiles = ''.join(tokens) if finished else ''
+            results.setdefault(smiles, []).append((position, choice))
+    return results
+
+
+class DerivationTree:
+    # Array-backed tree of a leftmost derivation, indexed by production position. When built from
+    # gene_to_cfg the position of a production is the position of the codon that selected it
+    # (positions >= n_codons were added by complete=True).
+    # Every output token records the production that emitted it, so e.g. the codons responsible for a metal
+    # centre are tree.positions('metal_symbol'), and the codon of the k-th token is tree.token_position[k]
+
+    def __init__(self, prod_rules, grammar=None, n_codons=None):
+        grammar = get_grammar(grammar)
+        self.grammar = grammar
+        n = len(prod_rules)
+        self.rules = array.array('i', prod_rules)
+        self.n_codons = n if n_codons is None else n_codons
+        # Parent production (-1 for the root) and index of the expanded symbol in the parent's rhs
+        self.parent = array.array('i', [-1]) * n
+        self.slot = array.array('i', [-1]) * n
+        self.first_child = array.array('i', [-1]) * n
+        # The subtree of pos is the productions pos..end[pos]-1, and it emitted the tokens
+        # token_start[pos]..token_end[pos]-1 (subtrees are contiguous in a leftmost derivation)
+        self.end = array.array('i', range(1, n + 1))
+        self.token_start = array.array('i', [0]) * n
+        self.token_end = array.array('i', [0]) * n
+        # Output tokens in order, the production that emitted each one and its offset in the SMILES
+        self.tokens = []
+        self.token_position = array.array('i')
+        self.token_offset = array.array('i')
+
+        n_nonterminals, symbol_strings = grammar.n_nonterminals, grammar.symbol_strings
+        rhs_offsets, rhs_symbols = grammar.rhs_offsets, grammar.rhs_symbols
+        none_id = grammar.nonterminal_id.get('None', -1)
+        n_chars = 0
+        pos = 0
+        # One pass over the derivation: terminals are kept on the stack too, so they are emitted in string order
+        stack = [(grammar.start_id, -1, -1)]
+        while stack:
+            symbol, up, slot = stack[-1]
+            if symbol >= n_nonterminals:
+                stack.pop()
+                self.tokens.append(symbol_strings[symbol])
+                self.token_position.append(up)
+                self.token_offset.append(n_chars)
+                n_chars += len(symbol_strings[symbol])
+                continue
+            if pos == n:
+                break
+            stack.pop()
+            rule = prod_rules[pos]
+            self.parent[pos] = up
+            self.slot[pos] = slot
+            if up >= 0 and self.first_child[up] < 0:
+                self.first_child[up] = pos
+            self.token_start[pos] = len(self.tokens)
+            first = rhs_offsets[rule]
+            stack.extend((rhs_symbols[k], pos, k - first) for k in range(rhs_offsets[rule + 1] - 1, first - 1, -1)
+                         if rhs_symbols[k] != none_id)
+            pos += 1
+        # Nonterminals left on the stack: the gene ran out before the derivation was finished
+        self.complete = not stack
+
+        for k, position in enumerate(self.token_position):
+            self.token_end[position] = k + 1
+        for pos in range(n):
+            if self.token_end[pos] < self.token_start[pos]:
+                self.token_end[pos] = self.token_start[pos]
+        for pos in range(n - 1, 0, -1):
+            up = self.parent[pos]
+            if up >= 0:
+                if self.end[pos] > self.end[up]:
+                    self.end[up] = self.end[pos]
+                if self.token_end[pos] > self.token_end[up]:
+                    self.token_end[up] = self.token_end[pos]
+        self._positions = None
+
+    def __len__(self):
+        return len(self.rules)
+
+    @property
+    def smiles(self):
+        # Same as decode: unfinished derivations give ''
+        return ''.join(self.tokens) if self.complete else ''
+
+    def lhs(self, pos):
+        return self.grammar.lhs[self.rules[pos]]
+
+    def children(self, pos):
+        # The next child starts where the subtree of the previous one ends
+        child = self.first_child[pos]
+        while child >= 0 and child < self.end[pos]:
+            yield child
+            child = self.end[child]
+
+    def subtree(self, pos):
+        return range(pos, self.end[pos])
+
+    def codons(self, pos):
+        # Codon positions of the subtree of pos (without the ones added by completion)
+        return range(pos, min(self.end[pos], self.n_codons))
+
+    def text(self, pos):
+        return ''.join(self.tokens[self.token_start[pos]:self.token_end[pos]])
+
+    def positions(self, symbol):
+        # Productions expanding a given nonterminal, e.g. 'metal_symbol' or 'ligand'
+        if self._positions is None:
+            self._positions = {}
+            for pos, rule in enumerate(self.rules):
+                self._positions.setdefault(self.grammar.lhs[rule], []).append(pos)
+        return self._positions.get(symbol, [])
+
+    def token_at(self, offset):
+        # Token covering a character offset of the SMILES
+        return bisect.bisect_right(self.token_offset, offset) - 1
+
+    def codon_at(self, offset):
+        # Codon that selected the token covering a character offset of the SMILES (-1 if none)
+        position = self.token_position[self.token_at(offset)]
+        return position if position < self.n_codons else -1
+
+
+def decode_tree(gene, max_steps=None, deadline=None, grammar=None, complete=False, codon_table=None,
+                valence=False):
+    # Decode a gene into a DerivationTree; tree.smiles is the decoded SMILES
+    grammar = get_grammar(grammar)
+    prod_rules = gene_to_cfg(gene, max_steps=max_steps, deadline=deadline, grammar=grammar, complete=complete,
+                             codon_table=codon_table, valence=valence)
+    return DerivationTree(prod_rules, grammar, n_codons=min(len(gene), len(prod_rules)))
+
+
+def ring_closure_tables(grammar):
+    # Symbols and productions involved in ring closures, built once per grammar
+    if 'ring_closures' not in grammar.cache:
+        nonterminal_id = grammar.nonterminal_id
+        digit_rules = {int(grammar.rhs[r][0][0]): r for r in grammar.rules_by_lhs.get('DIGIT', [])}
+        grammar.cache['ring_closures'] = {
+            'ringbond': nonterminal_id.get('ringbond', -1),
+            'RB': nonterminal_id.get('RB', -1),
+            'digit': nonterminal_id.get('DIGIT', -1),
+            # Nonterminals that produce exactly one atom, ring bonds belong to the last one
+            'atoms': {nonterminal_id[symbol] for symbol in ('atom', 'metal_complex') if symbol in nonterminal_id},
+            'digit_rules': digit_rules,
+            'digit_value': {r: digit for digit, r in digit_rules.items()},
+            # ringbond productions writing one two-digit label ('%' DIGIT DIGIT)
+            'percent_rules': {r for r in grammar.rules_by_lhs.get('ringbond', []) if ('%', False) in grammar.rhs[r]},
+            'rule_by_rhs': {(grammar.lhs_ids[r], rhs): r for r, rhs in enumerate(grammar.rhs)},
+        }
+    return grammar.cache['ring_closures']
+
+
+def ring_closure_events(prod_rules, grammar, tree):
+    # Ring closure labels in string order, every event is [atom index, is_percent, positions of its DIGITs]
+    tables = ring_closure_tables(grammar)
+    lhs_ids = grammar.lhs_ids
+    parent = tree.parent
+    events = []
+    percent_events = {}
+    atom = -1
+    for pos, rule in enumerate(prod_rules):
+        lhs = lhs_ids[rule]
+        if lhs in tables['atoms']:
+            atom += 1
+        if lhs != tables['digit'] or parent[pos] < 0 or lhs_ids[prod_rules[parent[pos]]] != tables['ringbond']:
+            continue
+        # A ringbond inside a bracket atom is not a ring closure (the parser also uses it for charges like [Co-3])
+        if lhs_ids[prod_rules[parent[parent[pos]]]] != tables['RB']:
+            continue
+        if prod_rules[parent[pos]] in tables['percent_rules']:
+            # Both digits write a single label
+            if parent[pos] not in percent_events:
+                percent_events[parent[pos]] = [atom, True, []]
+                events.append(percent_events[parent[pos]])
+            percent_events[parent[pos]][2].append(pos)
+        else:
+            # Every digit is a label of its own
+            events.append([atom, False, [pos]])
+    # Drop labels left unfinished by a short gene
+    return [event for event in events if len(event[2]) == (2 if event[1] else 1)]
+
+
+def match_ring_closures(events, labels):
+    # Match the labels as a SMILES parser would. Returns the partner of every event (None when unmatched)
+    partner = [None] * len(events)
+    open_rings = {}
+    unmatched = []
+    for i, event in enumerate(events):
+        j = open_rings.get(labels[i])
+        if j is None:
+            open_rings[labels[i]] = i
+        elif events[j][0] == event[0]:
+            # Would close the ring on its own atom
+            unmatched.append(i)
+        else:
+            del open_rings[labels[i]]
+            partner[i], partner[j] = j, i
+    return partner, sorted(unmatched + list(open_rings.values()))
+
+
+def remove_subtree(prod_rules, grammar, tree, pos):
+    # Remove the symbol expanded at pos from the derivation: the parent switches to the production
+    # with the same rhs minus that symbol, or is removed too if that leaves only the parent's own symbol.
+    # Only climbs through ring bond symbols. Returns the new prod_rules, or None if not possible
+    tables = ring_closure_tables(grammar)
+    parent, slot, end = tree.parent, tree.slot, tree.end
+    lhs_ids = grammar.lhs_ids
+    up = parent[pos]
+    if up < 0:
+        return None
+    up_lhs = lhs_ids[prod_rules[up]]
+    rhs = grammar.rhs[prod_rules[up]]
+    new_rhs = rhs[:slot[pos]] + rhs[slot[pos] + 1:]
+    new_rule = tables['rule_by_rhs'].get((up_lhs, new_rhs))
+    if new_rule is not None:
+        return prod_rules[:up] + [new_rule] + prod_rules[up + 1:pos] + prod_rules[end[pos]:]
+    if len(new_rhs) == 1 and new_rhs[0][1] and grammar.nonterminal_id[new_rhs[0][0]] == up_lhs:
+        # e.g. RB -> RB ringbond without the ringbond
+        return prod_rules[:up] + prod_rules[up + 1:pos] + prod_rules[end[pos]:]
+    if up_lhs in (tables['ringbond'], tables['RB']):
+        return remove_subtree(prod_rules, grammar, tree, up)
+    return None
+
+
+def close_ring_bonds(prod_rules, grammar):
+    # Ring-closure-aware decoding. The gene picks ring labels without knowing which rings are open,
+    # so mutants often leave rings unclosed or close a ring on the atom that opened it.
+    # Ring bonds that are already valid keep their labels (a valid gene decodes unchanged). The others are
+    # paired up in order, each with the next unmatched one on a different atom, and relabelled so that they
+    # close each other. Ring bonds still left without a partner are removed from the derivation.
+    tables = ring_closure_tables(grammar)
+    digit_rules, digit_value = tables['digit_rules'], tables['digit_value']
+    prod_rules = list(prod_rules)
+    tree = DerivationTree(prod_rules, grammar)
+    events = ring_closure_events(prod_rules, grammar, tree)
+    if not events:
+        return prod_rules
+
+    def label_of(event):
+        positions = event[2]
+        if event[1]:
+            return 10 * digit_value[prod_rules[positions[0]]] + digit_value[prod_rules[positions[1]]]
+        return digit_value[prod_rules[positions[0]]]
+
+    original_labels = [label_of(event) for event in events]
+    partner, unmatched = match_ring_closures(events, original_labels)
+
+    # Pair the remaining ones with the same label kind, on different atoms
+    waiting = []
+    for i in unmatched:
+        for k, j in enumerate(waiting):
+            if events[j][0] != events[i][0] and events[j][1] == events[i][1]:
+                partner[i], partner[j] = j, i
+                del waiting[k]
+                break
+        else:
+            waiting.append(i)
+
+    # Assign the labels, keeping the original one whenever it is free
+    labels = [None] * len(events)
+    in_use = set()
+    conflicts = False
+    for i, event in enumerate(events):
+        j = partner[i]
+        if j is not None and j < i:
+            label = labels[j]
+            in_use.discard(label)
+        else:
+            label = original_labels[i]
+            if label in in_use:
+                # A percent label can also be written with one digit (%05 is 5), so a ring with
+                # a single-digit end needs a single-digit label
+                percent = event[1] and (j is None or events[j][1])
+                allowed = range(10, 100) if percent else range(10)
+                label = next((free for free in allowed if free not in in_use), label)
+                # No free label left, the ring bond stays unmatched
+                conflicts = conflicts or label in in_use
+            in_use.add(label)
+        labels[i] = label
+        positions = event[2]
+        if event[1]:
+            prod_rules[positions[0]] = digit_rules[label // 10]
+            prod_rules[positions[1]] = digit_rules[label % 10]
+        else:
+            prod_rules[positions[0]] = digit_rules[label]
+
+    # Remove the ring bonds still unmatched (unpaired, or without a free label) one at a time,
+    # last one first, since positions move after every removal
+    while waiting or conflicts:
+        tree = DerivationTree(prod_rules, grammar)
+        events = ring_closure_events(prod_rules, grammar, tree)
+        partner, unmatched = match_ring_closures(events, [label_of(event) for event in events])
+        if not unmatched:
+            break
+        for i in reversed(unmatched):
+            positions = events[i][2]
+            # A percent label is removed with its ringbond, a single digit on its own if the ringbond has two
+            pos = tree.parent[positions[0]] if events[i][1] else positions[0]
+            new_rules = remove_subtree(prod_rules, grammar, tree, pos)
+            if new_rules is not None:
+                prod_rules = new_rules
+                break
+        else:
+            break
     return prod_rules
+
+
+def valence_tables(grammar):
+    # Symbols and productions read by valence-aware decoding, built once per grammar.
+    # Symbols missing from a grammar (e.g. metal_symbol in the organic one) get id -2, which matches nothing
+    if 'valence' not in grammar.cache:
+        names = ['bond', 'hcount', 'charge', 'BACH', 'DIGIT', 'RB', 'BB', 'branch', 'ringbond', 'ligand', 'metal_complex',
+                 'symbol', 'aliphatic_organic', 'aromatic_organic', 'metal_symbol', 'sulfur_aromatic',
+                 'bracketed_atom_symbol']
+        ids = {name: grammar.nonterminal_id.get(name, -2) for name in names}
+        orders = {'-': 1, '/': 1, '\\': 1, ':': 1, '=': 2, '#': 3, '$': 4}
+        # Terminal of every single-terminal production (bond orders, elements, digits)
+        terminal = {}
+        for r in range(len(grammar)):
+            symbols = grammar.rhs_symbols[grammar.rhs_offsets[r]:grammar.rhs_offsets[r + 1]]
+            if len(symbols) == 1 and symbols[0] >= grammar.n_nonterminals:
+                terminal[r] = grammar.symbol_strings[symbols[0]]
+
+        def alternatives(name):
+            n = ids[name]
+            return list(grammar.choice_rules[grammar.choice_offsets[n]:grammar.choice_offsets[n + 1]]) if n >= 0 else []
+
+        grammar.cache['valence'] = {
+            'ids': ids,
+            'orders': orders,
+            'bond_rules': [(r, orders.get(terminal.get(r), 1)) for r in alternatives('bond')],
+            'element_rules': {ids[name]: [(r, terminal[r]) for r in alternatives(name)]
+                              for name in ('aliphatic_organic', 'aromatic_organic', 'metal_symbol') if ids[name] >= 0},
+            'digit_rules': [(r, int(terminal[r])) for r in alternatives('DIGIT')],
+            # hcount alternatives with the room they need: 'H' takes one hydrogen, 'H' DIGIT is only useful for more
+            'hcount_rules': [(r, grammar.rhs_offsets[r + 1] - grammar.rhs_offsets[r]) for r in alternatives('hcount')],
+            # Alternatives of RB and BB, and those that ask for one more ring bond / branch
+            'alternatives': {ids[name]: alternatives(name) for name in ('RB', 'BB') if ids[name] >= 0},
+            'more_rules': {ids[name]: [r for r in alternatives(name)
+                                       if grammar.rhs_offsets[r + 1] - grammar.rhs_offsets[r] > 1]
+                           for name in ('RB', 'BB') if ids[name] >= 0},
+        }
+    return grammar.cache['valence']
+
+
+class ValenceState:
+    # Atoms and bond orders of a SMILES read token by token while it is derived. Every token is seen with
+    # the production that emitted it (lhs) and the parent of that lhs, which tells e.g. a hydrogen count digit
+    # from a ring label. used[atom] counts bonds, ring bonds and hydrogens, capacity[atom] comes from max_bonds
+
+    def __init__(self, tables):
+        self.ids = tables['ids']
+        self.tables = tables
+        self.capacity = []
+        self.used = []
+        self.symbols = []
+        self.bracketed = set()  # atoms written in brackets, their charge is explicit
+        self.prev = -1  # atom the next bond or atom attaches to
+        self.pending = None  # order of a bond token not yet attached
+        self.branches = []
+        self.centres = []  # metal atoms of the open metal complexes, their ligands bond to them
+        self.bracket = -1
+        self.charge_sign = 0
+        self.charge_digits = ''
+        self.percent = None
+        self.open_rings = {}  # label: (atom that opened it, order of its bond)
+        self.opened = {}  # ring bonds opened by every atom and not closed yet
+
+    def remaining(self, atom):
+        return self.capacity[atom] - self.used[atom] if atom >= 0 else 0
+
+    def add_atom(self, symbol, aromatic=False, metal=False, attach=None, bracketed=False):
+        atom = len(self.capacity)
+        self.symbols.append((symbol, aromatic, metal))
+        self.capacity.append(max_bonds(symbol, aromatic, metal, bracketed=bracketed))
+        self.used.append(0)
+        if bracketed:
+            self.bracketed.add(atom)
+        attach = self.prev if attach is None else attach
+        if attach >= 0:
+            self.add_bond(attach, atom, self.pending or 1)
+        self.pending = None
+        return atom
+
+    def add_bond(self, a, b, order):
+        # Metal-ligand bonds are dative and written without charges, they only count for the metal
+        if self.symbols[a][2] or not self.symbols[b][2]:
+            self.used[a] += order
+        if self.symbols[b][2] or not self.symbols[a][2]:
+            self.used[b] += order
+
+    def ring_label(self, label):
+        # A ring bond is counted when it closes, once it is known whether it bonds a ligand to a metal
+        if label in self.open_rings:
+            atom, order = self.open_rings.pop(label)
+            self.opened[atom] -= 1
+            self.add_bond(atom, self.prev, self.pending or order)
+        else:
+            self.open_rings[label] = (self.prev, self.pending or 1)
+            self.opened[self.prev] = self.opened.get(self.prev, 0) + 1
+        self.pending = None
+
+    def emit(self, token, lhs, parent):
+        ids = self.ids
+        if lhs == ids['bond']:
+            self.pending = self.tables['orders'].get(token, 1)
+        elif lhs in (ids['aliphatic_organic'], ids['aromatic_organic'], ids['metal_symbol']):
+            aromatic, metal = lhs == ids['aromatic_organic'], lhs == ids['metal_symbol']
+            if parent == ids['ligand']:
+                self.add_atom(token, aromatic, metal, attach=self.centres[-1] if self.centres else -1)
+                return
+            bracketed = parent == ids['symbol'] or metal
+            self.prev = self.add_atom(token, aromatic, metal, bracketed=bracketed)
+            if bracketed:
+                self.bracket = self.prev
+                self.charge_sign, self.charge_digits = 0, ''
+            if parent == ids['metal_complex']:
+                self.centres.append(self.prev)
+        elif lhs == ids['sulfur_aromatic']:
+            self.prev = self.add_atom(token, aromatic=token.islower())
+        elif lhs == ids['bracketed_atom_symbol']:
+            if token.startswith('[Sc'):
+                self.prev = self.bracket = self.add_atom('Sc', metal=True, bracketed=True)
+        elif lhs == ids['branch']:
+            if token == '(':
+                self.branches.append(self.prev)
+            elif token == ')' and self.branches:
+                self.prev = self.branches.pop()
+        elif lhs == ids['hcount']:
+            self.used[self.bracket] += 1
+        elif lhs == ids['charge']:
+            self.charge_sign = 1 if token == '+' else -1
+            self.update_charge()
+        elif lhs == ids['ringbond'] and token == '%':
+            self.percent = ''
+        elif lhs == ids['metal_complex'] and token == ']' and self.centres:
+            centre = self.centres.pop()
+            self.prev = self.centres[-1] if self.centres else centre
+        elif lhs == ids['DIGIT']:
+            if parent == ids['hcount']:
+                self.used[self.bracket] += int(token) - 1
+            elif parent == ids['charge']:
+                self.charge_digits += token
+                self.update_charge()
+            elif parent == ids['ringbond'] and self.prev >= 0:
+                if self.percent is None:
+                    self.ring_label(token)
+                else:
+                    self.percent += token
+                    if len(self.percent) == 2:
+                        self.ring_label('%' + self.percent)
+                        self.percent = None
+
+    def update_charge(self):
+        if self.bracket < 0:
+            return
+        charge = self.charge_sign * (int(self.charge_digits) if self.charge_digits else 1)
+        symbol, aromatic, metal = self.symbols[self.bracket]
+        self.capacity[self.bracket] = max_bonds(symbol, aromatic, metal, charge, bracketed=True)
+
+    def bond_room(self, atom):
+        # Bond order still available to a bond leaving atom. Donor atoms written without brackets may take
+        # the valence of their cation, as the O of a neutral carbonyl (O#C)
+        room = self.remaining(atom)
+        if atom not in self.bracketed:
+            symbol, aromatic, metal = self.symbols[atom]
+            room += max_bonds(symbol, aromatic, metal, DONOR_CHARGE.get(symbol.capitalize(), 0)) - self.capacity[atom]
+        return room
+
+    def charge_follows(self, stack):
+        # A charge is still to come in the current bracket atom (SMILES writes it after the hydrogens)
+        return bool(stack) and stack[-1][0] in (self.ids['BACH'], self.ids['charge'])
+
+    def allowed(self, symbol, parent, stack):
+        # Productions of symbol that keep every atom within its capacity, None when there is no restriction
+        ids, tables = self.ids, self.tables
+        if symbol == ids['bond']:
+            attach = self.centres[-1] if parent == ids['ligand'] and self.centres else self.prev
+            if attach < 0:
+                return None
+            # A saturated atom still gets the bond the derivation asked for, but a single one
+            return [r for r, order in tables['bond_rules'] if order <= max(self.bond_room(attach), 1)]
+        if symbol in tables['element_rules']:
+            attach = self.centres[-1] if parent == ids['ligand'] and self.centres else self.prev
+            if attach < 0:
+                return None
+            if self.symbols[attach][2]:
+                return None
+            order = self.pending or 1
+            metal = symbol == ids['metal_symbol']
+            aromatic = symbol == ids['aromatic_organic']
+            bracketed = parent == ids['symbol']
+            # Donor atoms may take the bond with the valence of their cation, as in neutral carbonyls (C#O)
+            return [r for r, element in tables['element_rules'][symbol]
+                    if max_bonds(element, aromatic, metal, DONOR_CHARGE.get(element.capitalize(), 0), bracketed)
+                    >= order]
+        if symbol == ids['hcount'] or (symbol == ids['DIGIT'] and parent == ids['hcount']):
+            # The capacity of a main-group atom depends on its charge ([NH4+], [BH4-]), which is not known yet
+            if self.charge_follows(stack) and not self.symbols[self.bracket][2]:
+                return None
+        if symbol == ids['hcount']:
+            return [r for r, n in tables['hcount_rules'] if n <= max(self.remaining(self.bracket), 1)]
+        if symbol == ids['DIGIT'] and parent == ids['hcount']:
+            # 'H' already took one
+            return [r for r, digit in tables['digit_rules'] if digit <= max(self.remaining(self.bracket), 0) + 1]
+        if symbol in tables['more_rules']:
+            # One more ring bond or branch on top of those already committed (right below on the stack)
+            item = ids['ringbond'] if symbol == ids['RB'] else ids['branch']
+            committed = 0
+            while committed < len(stack) and stack[-1 - committed][0] == item and stack[-1 - committed][1] == symbol:
+                committed += 1
+            # Ring bonds still open may go to a metal and cost nothing, they are only counted here
+            if self.remaining(self.prev) - self.opened.get(self.prev, 0) >= committed + 2:
+                return None
+            return [r for r in tables['alternatives'][symbol] if r not in tables['more_rules'][symbol]]
+        return None
+
+
+def valence_gene_to_cfg(gene, grammar, max_steps=None, deadline=None, codon_table=None):
+    # Leftmost derivation that keeps track of the atoms (ValenceState) and only lets the gene pick bonds, elements,
+    # hydrogen counts and extra ring bonds or branches the current atom still has room for. A codon selecting a
+    # forbidden production is redirected to allowed[choice % len(allowed)], choice being the alternative index of
+    # the forbidden production, so the outcome only depends on the production the codon selects.
+    # Returns the productions and the stack of nonterminals left open when the gene ran out
+    state = ValenceState(valence_tables(grammar))
+    n_nonterminals, symbol_strings = grammar.n_nonterminals, grammar.symbol_strings
+    choice_offsets, choice_rules, rule_choice = grammar.choice_offsets, grammar.choice_rules, grammar.rule_choice
+    rhs_offsets, rhs_symbols = grammar.rhs_offsets, grammar.rhs_symbols
+    none_id = grammar.nonterminal_id.get('None', -1)
+    prod_rules = []
+    # (symbol, lhs of the production that pushed it, parent of that lhs)
+    stack = [(grammar.start_id, -1, -1)]
+    step = 0
+    while stack:
+        symbol, lhs, parent = stack.pop()
+        if symbol >= n_nonterminals:
+            state.emit(symbol_strings[symbol], lhs, parent)
+            continue
+        if step >= len(gene):
+            stack.append((symbol, lhs, parent))
+            break
+        check_budget(step, max_steps, deadline)
+        if codon_table is None:
+            first = choice_offsets[symbol]
+            rule = choice_rules[first + gene[step] % (choice_offsets[symbol + 1] - first)]
+        else:
+            rule = codon_table.rule(symbol, gene[step])
+        allowed = state.allowed(symbol, lhs, stack)
+        if allowed and rule not in allowed:
+            rule = allowed[rule_choice[rule] % len(allowed)]
+        prod_rules.append(rule)
+        step += 1
+        for k in range(rhs_offsets[rule + 1] - 1, rhs_offsets[rule] - 1, -1):
+            if rhs_symbols[k] != none_id:
+                stack.append((rhs_symbols[k], symbol, lhs))
+    return prod_rules, [symbol for symbol, _, _ in stack if symbol < n_nonterminals]
@@ -0,0 +1,107 @@
+# nltk chart parsing used by cfg_util.encode
+# Kept in its own module so that importing cfg_util (and decoding genes) does not import nltk
+import tracemalloc
+
+import nltk
+import nltk.parse.chart
+
+from cfg_util import CHART_EDGE_BYTES, MemoryLimitExceeded, check_budget
+
+
+class BudgetedChartParser(nltk.ChartParser):
+    # Same agenda-based algorithm as nltk.ChartParser.chart_parse, with a budget check
+    # on the number of chart edges, a monotonic deadline and a memory ceiling for every popped edge.
+    # Memory is measured exactly with tracemalloc when trace_memory is set (about 3x slower),
+    # otherwise it is estimated from the chart size.
+
+    def __init__(self, grammar, max_edges=None, deadline=None, max_memory=None, trace_memory=False,
+                 **parser_args):
+        super().__init__(grammar, **parser_args)
+        self.max_edges = max_edges
+        self.deadline = deadline
+        self.max_memory = max_memory
+        self.trace_memory = trace_memory
+        # Filled by chart_parse, also when the parse is aborted
+        self.chart_edges = 0
+        self.peak_bytes = 0
+
+    def chart_parse(self, tokens, trace=None):
+        tokens = list(tokens)
+        self._grammar.check_coverage(tokens)
+        chart = self._chart_class(tokens)
+        grammar = self._grammar
+
+        started_tracing = False
+        baseline = None
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+
+        def memory_used():
+            if baseline is not None:
+                return tracemalloc.get_traced_memory()[0] - baseline
+            return chart.num_edges() * CHART_EDGE_BYTES
+
+        try:
+            for axiom in self._axioms:
+                list(axiom.apply(chart, grammar))
+
+            agenda = chart.edges()
+            agenda.reverse()
+            while agenda:
+                check_budget(chart.num_edges(), self.max_edges, self.deadline)
+                if self.max_memory is not None and memory_used() > self.max_memory:
+                    raise MemoryLimitExceeded(f'Chart memory above {self.max_memory} bytes '
+                                              f'({chart.num_edges()} edges)')
+                edge = agenda.pop()
+                for rule in self._inference_rules:
+                    agenda += list(rule.apply(chart, grammar, edge))
+            return chart
+        finally:
+            # The chart only grows, so its final size is also its peak size
+            self.chart_edges = chart.num_edges()
+            if baseline is not None:
+                self.peak_bytes = tracemalloc.get_traced_memory()[1] - baseline
+            else:
+                self.peak_bytes = memory_used()
+            if started_tracing:
+                tracemalloc.stop()
+
+
+def first_parse_productions(chart, grammar, max_steps=None, deadline=None):
+    # Productions (in pre-order) of the first tree that chart.parses() would return,
+    # read directly from the child pointers instead of materialising every parse tree
+    steps = 0
+    in_progress = set()
+
+    def expand(edge):
+        nonlocal steps
+        if isinstance(edge, nltk.parse.chart.LeafEdge):
+            return []
+        if edge.is_incomplete() or edge in in_progress:
+            return None
+        steps += 1
+        check_budget(steps, max_steps, deadline)
+        in_progress.add(edge)
+        try:
+            for cpl in chart.child_pointer_lists(edge):
+                productions = [nltk.grammar.Production(edge.lhs(), edge.rhs())]
+                for child in cpl:
+                    child_productions = expand(child)
+                    if child_productions is None:
+                        break
+                    productions += child_productions
+                else:
+                    return productions
+            return None
+        finally:
+            in_progress.discard(edge)
+
+    for edge in chart.select(start=0, end=chart.num_leaves(), lhs=grammar.start()):
+        productions = expand(edge)
+        if productions is not None:
+            return productions
+    return None
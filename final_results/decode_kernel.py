@@ -0,0 +1,145 @@
+# Batch decoding of genes on the integer grammar tables, compiled with numba when it is installed.
+# The kernels are the loops of gene_to_cfg (codon -> production) and rules_to_smiles (production -> symbol ids)
+# written on flat numpy arrays, so that numba can compile them to machine code and a whole population is decoded
+# in one call without going through the interpreter for every codon. Without numba the same functions run as
+# plain Python, which is slower than the list-based loops of cfg_util: decode_genes only uses them when
+# JIT_AVAILABLE is set, and the output is the same either way.
+# Only plain decoding is covered (no codon table, valence, ring closing or completion).
+import numpy as np
+
+# Genes decoded per kernel call, bounds the memory of the symbol buffers
+BATCH_SIZE = 1024
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+JIT_AVAILABLE = numba is not None
+
+
+def jit(function):
+    # Compiled on first call (and cached on disk next to the module) when numba is available
+    if numba is None:
+        return function
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+@jit
+def derive_rules(gene, n_codons, choice_offsets, choice_rules, stack_offsets, stack_symbols, start_id, rules,
+                 stack):
+    # Productions used by gene[:n_codons] (gene_to_cfg), written to rules. Returns how many there are
+    n_rules = 0
+    stack[0] = start_id
+    top = 1
+    for step in range(n_codons):
+        if top == 0:
+            break
+        top -= 1
+        lhs = stack[top]
+        first_rule = choice_offsets[lhs]
+        rule = choice_rules[first_rule + gene[step] % (choice_offsets[lhs + 1] - first_rule)]
+        rules[n_rules] = rule
+        n_rules += 1
+        for i in range(stack_offsets[rule], stack_offsets[rule + 1]):
+            stack[top] = stack_symbols[i]
+            top += 1
+    return n_rules
+
+
+@jit
+def derive_symbols(rules, n_rules, lhs_ids, rhs_offsets, rhs_symbols, nothing_id, n_nonterminals, seq):
+    # Symbol ids of the leftmost derivation of rules[:n_rules] (rules_to_smiles), written to seq.
+    # Returns their number, or -1 if a nonterminal is left (decoded as '')
+    if n_rules == 0:
+        return -1
+    seq[0] = lhs_ids[rules[0]]
+    length = 1
+    for k in range(n_rules):
+        r = rules[k]
+        lhs = lhs_ids[r]
+        if lhs == nothing_id:
+            break
+        ix = 0
+        while ix < length and seq[ix] != lhs:
+            ix += 1
+        if ix == length:
+            continue
+        start, end = rhs_offsets[r], rhs_offsets[r + 1]
+        shift = end - start - 1
+        # Make room for the rhs (or close the gap of an empty one), then write it over the lhs
+        if shift > 0:
+            for j in range(length - 1, ix, -1):
+                seq[j + shift] = seq[j]
+        elif shift < 0:
+            for j in range(ix + 1, length):
+                seq[j + shift] = seq[j]
+        for j in range(start, end):
+            seq[ix + j - start] = rhs_symbols[j]
+        length += shift
+    for j in range(length):
+        if seq[j] < n_nonterminals:
+            return -1
+    return length
+
+
+@jit
+def decode_batch(genes, lengths, choice_offsets, choice_rules, stack_offsets, stack_symbols, start_id, lhs_ids,
+                 rhs_offsets, rhs_symbols, nothing_id, n_nonterminals, rules, stack, symbols, n_symbols):
+    # Symbol ids of every gene (a row of genes, lengths[i] codons) in the rows of symbols, their number in
+    # n_symbols (-1 for an unfinished derivation). rules and stack are work buffers of derive_rules
+    for i in range(genes.shape[0]):
+        n_rules = derive_rules(genes[i], lengths[i], choice_offsets, choice_rules, stack_offsets, stack_symbols,
+                               start_id, rules, stack)
+        n_symbols[i] = derive_symbols(rules, n_rules, lhs_ids, rhs_offsets, rhs_symbols, nothing_id, n_nonterminals,
+                                      symbols[i])
+
+
+def kernel_arrays(tables):
+    # int64 copies of the integer tables used by the kernels, made once per grammar
+    arrays = tables.cache.get('kernel_arrays')
+    if arrays is None:
+        arrays = {name: np.asarray(getattr(tables, name), dtype=np.int64)
+                  for name in ('choice_offsets', 'choice_rules', 'stack_offsets', 'stack_symbols', 'lhs_ids',
+                               'rhs_offsets', 'rhs_symbols')}
+        # Largest number of symbols in a rhs, and of nonterminals pushed on the stack by a production
+        arrays['max_rhs'] = int(np.diff(arrays['rhs_offsets']).max(initial=1))
+        arrays['max_push'] = int(np.diff(arrays['stack_offsets']).max(initial=1))
+        tables.cache['kernel_arrays'] = arrays
+    return arrays
+
+
+def pack_genes(genes):
+    # Genes of any lengths as one padded int64 array and the length of every row
+    lengths = np.array([len(gene) for gene in genes], dtype=np.int64)
+    packed = np.zeros((len(genes), max(1, lengths.max(initial=0))), dtype=np.int64)
+    for i, gene in enumerate(genes):
+        packed[i, :lengths[i]] = gene
+    return packed, lengths
+
+
+def decode_symbols(genes, tables):
+    # Symbol ids (rows of an array) and their numbers for a batch of genes
+    arrays = kernel_arrays(tables)
+    packed, lengths = pack_genes(genes)
+    max_codons = packed.shape[1]
+    rules = np.empty(max_codons, dtype=np.int64)
+    # Every production pops one nonterminal and pushes at most max_push, adds at most max_rhs - 1 symbols
+    stack = np.empty(max_codons * max(1, arrays['max_push'] - 1) + 2, dtype=np.int64)
+    symbols = np.empty((len(genes), max_codons * max(1, arrays['max_rhs'] - 1) + 1), dtype=np.int64)
+    n_symbols = np.empty(len(genes), dtype=np.int64)
+    decode_batch(packed, lengths, arrays['choice_offsets'], arrays['choice_rules'], arrays['stack_offsets'],
+                 arrays['stack_symbols'], tables.start_id, arrays['lhs_ids'], arrays['rhs_offsets'],
+                 arrays['rhs_symbols'], tables.nothing_id, tables.n_nonterminals, rules, stack, symbols, n_symbols)
+    return symbols, n_symbols
+
+
+def decode_population(genes, tables):
+    # decode(gene_to_cfg(gene)) of every gene
+    strings = tables.symbol_strings
+    smiles = []
+    for start in range(0, len(genes), BATCH_SIZE):
+        symbols, n_symbols = decode_symbols(genes[start:start + BATCH_SIZE], tables)
+        smiles += [''.join([strings[s] for s in row[:n].tolist()]) if n >= 0 else ''
+                   for row, n in zip(symbols, n_symbols.tolist())]
+    return smiles
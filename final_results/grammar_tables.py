@@ -0,0 +1,287 @@
+# Plain-Python tables compiled from a grammar string, and a registry of the compiled grammars
+# Decoding genes only needs, for every production, its lhs and rhs symbols. These are compiled once with nltk
+# and cached on disk as a small pickle keyed by a hash of the grammar, so later processes load them without
+# importing nltk (or numpy) at all.
+# Several grammars (e.g. the organic and the inorganic one) can be used side by side in one process:
+# every compiled grammar keeps its own caches (nltk CFG, tokenizer, production indices).
+# The integer tables can be placed once in shared memory and attached zero-copy by worker processes.
+import array
+import hashlib
+import importlib.util
+import json
+import os
+import pickle
+import sys
+from multiprocessing import shared_memory
+
+# Increase when the layout of the cached tables changes
+TABLES_VERSION = 2
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(MODULE_DIR, 'grammar_cache')
+
+# Grammars that can be requested by name, loaded from the 'gram' string of their module
+GRAMMAR_FILES = {
+    'inorganic': os.path.join(MODULE_DIR, 'smiles_grammar_inorganic.py'),
+    'organic': os.path.join(MODULE_DIR, os.pardir, 'original_code', 'smiles_grammar.py'),
+}
+DEFAULT_GRAMMAR = 'inorganic'
+
+
+def grammar_hash(gram):
+    return hashlib.sha256(f'{TABLES_VERSION}\n{gram}'.encode('utf-8')).hexdigest()
+
+
+# Integer tables used by the decoding loops, stored as int32 arrays in one buffer
+# (a private bytearray, or a shared memory block attached by worker processes)
+INT_ARRAYS = ('lhs_ids', 'rule_choice', 'choice_offsets', 'choice_rules',
+              'stack_offsets', 'stack_symbols', 'rhs_offsets', 'rhs_symbols', 'min_rules')
+
+
+def pack_int_arrays(arrays):
+    # Concatenate the int32 arrays, the layout gives (start, length) of each one in items
+    layout = {}
+    packed = array.array('i')
+    for name in INT_ARRAYS:
+        layout[name] = (len(packed), len(arrays[name]))
+        packed.extend(arrays[name])
+    return bytearray(packed.tobytes()), layout
+
+
+def int_array_views(buffer, layout):
+    # Zero-copy int32 views on a packed buffer
+    buffer = memoryview(buffer)
+    return {name: buffer[start * 4:(start + length) * 4].cast('i') for name, (start, length) in layout.items()}
+
+
+class GrammarTables:
+
+    def __init__(self, name, gram, gram_hash, lhs, rhs, terminals, buffer=None, layout=None):
+        self.name = name
+        self.gram = gram
+        self.hash = gram_hash
+        # lhs symbol of every production, in GCFG.productions() order
+        self.lhs = lhs
+        # rhs of every production as a tuple of (symbol, is_nonterminal)
+        self.rhs = rhs
+        # Terminal symbols in the order of nltk's lexical index (the tokenizer depends on it)
+        self.terminals = terminals
+
+        self.start = lhs[0]
+        # Production indices available for every nonterminal
+        self.rules_by_lhs = {}
+        for ix, symbol in enumerate(lhs):
+            self.rules_by_lhs.setdefault(symbol, []).append(ix)
+
+        # Nonterminals get ids 0..n_nonterminals-1 (in order of appearance), terminals follow them,
+        # so a symbol id >= n_nonterminals is the terminal terminals[id - n_nonterminals]
+        self.nonterminals = list(self.rules_by_lhs)
+        for r in rhs:
+            for symbol, is_nonterminal in r:
+                if is_nonterminal and symbol not in self.nonterminals:
+                    self.nonterminals.append(symbol)
+        self.nonterminal_id = {symbol: ix for ix, symbol in enumerate(self.nonterminals)}
+        self.n_nonterminals = len(self.nonterminals)
+        self.start_id = self.nonterminal_id[self.start]
+        self.nothing_id = self.nonterminal_id.get('Nothing', -1)
+        self.symbol_strings = self.nonterminals + list(terminals)
+
+        if buffer is None:
+            buffer, layout = pack_int_arrays(self.build_int_arrays())
+        self.buffer = buffer
+        self.layout = layout
+        views = int_array_views(buffer, layout)
+        # lhs id of every production
+        self.lhs_ids = views['lhs_ids']
+        # Position of every production among the alternatives of its lhs (the value stored in a gene)
+        self.rule_choice = views['rule_choice']
+        # Alternatives of nonterminal n are choice_rules[choice_offsets[n]:choice_offsets[n + 1]]
+        self.choice_offsets = views['choice_offsets']
+        self.choice_rules = views['choice_rules']
+        # Nonterminals pushed on the decoding stack by every production (without 'None'), already reversed
+        self.stack_offsets = views['stack_offsets']
+        self.stack_symbols = views['stack_symbols']
+        # Symbol ids of the rhs of every production
+        self.rhs_offsets = views['rhs_offsets']
+        self.rhs_symbols = views['rhs_symbols']
+        # First production of the shortest terminal derivation of every nonterminal (-1 if there is none)
+        self.min_rules = views['min_rules']
+
+        # Per-grammar caches filled by the functions that use this grammar (never pickled or shared)
+        self.cache = {}
+        self._cfg = None
+        self._shm = None
+
+    def symbol_id(self, symbol, is_nonterminal):
+        if is_nonterminal:
+            return self.nonterminal_id[symbol]
+        return self.n_nonterminals + self.terminals.index(symbol)
+
+    def build_int_arrays(self):
+        arrays = {name: [] for name in INT_ARRAYS}
+        arrays['lhs_ids'] = [self.nonterminal_id[symbol] for symbol in self.lhs]
+        arrays['rule_choice'] = [self.rules_by_lhs[symbol].index(ix) for ix, symbol in enumerate(self.lhs)]
+        arrays['choice_offsets'] = [0]
+        for symbol in self.nonterminals:
+            arrays['choice_rules'] += self.rules_by_lhs.get(symbol, [])
+            arrays['choice_offsets'].append(len(arrays['choice_rules']))
+        arrays['stack_offsets'] = [0]
+        arrays['rhs_offsets'] = [0]
+        for r in self.rhs:
+            arrays['stack_symbols'] += [self.nonterminal_id[symbol] for symbol, is_nonterminal in reversed(r)
+                                        if is_nonterminal and symbol != 'None']
+            arrays['stack_offsets'].append(len(arrays['stack_symbols']))
+            arrays['rhs_symbols'] += [self.symbol_id(symbol, is_nonterminal) for symbol, is_nonterminal in r]
+            arrays['rhs_offsets'].append(len(arrays['rhs_symbols']))
+        arrays['min_rules'] = self.minimal_expansion_rules()
+        return arrays
+
+    def minimal_expansion_rules(self):
+        # Shortest derivation of every nonterminal into terminals: fewest terminal characters, then fewest
+        # productions, lowest production index on ties. Bellman-Ford style relaxation until nothing changes
+        unreachable = (float('inf'), float('inf'))
+        cost = {symbol: unreachable for symbol in self.nonterminals}
+        best = {symbol: -1 for symbol in self.nonterminals}
+        changed = True
+        while changed:
+            changed = False
+            for ix, (symbol, r) in enumerate(zip(self.lhs, self.rhs)):
+                n_chars, n_rules = 0, 1
+                for s, is_nonterminal in r:
+                    if is_nonterminal:
+                        n_chars += cost[s][0]
+                        n_rules += cost[s][1]
+                    else:
+                        n_chars += len(s)
+                if (n_chars, n_rules) < cost[symbol]:
+                    cost[symbol] = (n_chars, n_rules)
+                    best[symbol] = ix
+                    changed = True
+        return [best[symbol] for symbol in self.nonterminals]
+
+    def __len__(self):
+        return len(self.lhs)
+
+    def __repr__(self):
+        return f'GrammarTables({self.name!r}, {self.hash[:16]}, {len(self)} productions)'
+
+    @property
+    def cfg(self):
+        # The nltk CFG, only built when chart parsing is needed
+        if self._cfg is None:
+            import nltk
+            self._cfg = nltk.CFG.fromstring(self.gram)
+        return self._cfg
+
+    def to_dict(self):
+        return {'version': TABLES_VERSION, 'name': self.name, 'gram': self.gram, 'hash': self.hash,
+                'lhs': self.lhs, 'rhs': self.rhs, 'terminals': self.terminals}
+
+
+def compile_tables(gram, name):
+    import nltk
+
+    cfg = nltk.CFG.fromstring(gram)
+    lhs = [str(prod.lhs()) for prod in cfg.productions()]
+    rhs = [tuple((str(s), True) if isinstance(s, nltk.grammar.Nonterminal) else (s, False) for s in prod.rhs())
+           for prod in cfg.productions()]
+    terminals = list(cfg._lexical_index.keys())
+    tables = GrammarTables(name, gram, grammar_hash(gram), lhs, rhs, terminals)
+    tables._cfg = cfg
+    return tables
+
+
+def load_tables(gram, name, cache_dir=CACHE_DIR):
+    gram_hash = grammar_hash(gram)
+    cache_file = os.path.join(cache_dir, f'{name}-{gram_hash[:16]}.pkl')
+    try:
+        with open(cache_file, 'rb') as f:
+            data = pickle.load(f)
+        if data['version'] == TABLES_VERSION and data['hash'] == gram_hash:
+            return GrammarTables(data['name'], data['gram'], data['hash'], data['lhs'], data['rhs'],
+                                 data['terminals'])
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+
+    tables = compile_tables(gram, name)
+    try:
+        # Write to a temporary file first, several workers may build the cache at the same time
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(tables.to_dict(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # Read-only checkout: keep working without the cache
+        pass
+    return tables
+
+
+# Compiled grammars by (name, hash), and the most recently registered grammar for every name
+_registry = {}
+_latest = {}
+
+
+def register_grammar(name, gram):
+    key = (name, grammar_hash(gram))
+    if key not in _registry:
+        _registry[key] = load_tables(gram, name)
+    _latest[name] = _registry[key]
+    return _registry[key]
+
+
+def load_grammar_string(name):
+    # Execute the grammar module by path, so original_code does not need to be importable
+    spec = importlib.util.spec_from_file_location(f'_grammar_{name}', GRAMMAR_FILES[name])
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.gram
+
+
+def get_grammar(grammar=None, gram_hash=None):
+    # grammar is a registered name, an already compiled GrammarTables or None for DEFAULT_GRAMMAR
+    if isinstance(grammar, GrammarTables):
+        return grammar
+    if grammar is None:
+        grammar = DEFAULT_GRAMMAR
+    if gram_hash is not None:
+        return _registry[(grammar, gram_hash)]
+    if grammar not in _latest:
+        if grammar not in GRAMMAR_FILES:
+            raise KeyError(f'Unknown grammar {grammar!r}, register it first with register_grammar')
+        register_grammar(grammar, load_grammar_string(grammar))
+    return _latest[grammar]
+
+
+def share_grammar(grammar=None):
+    # Copy the tables of a grammar into a new shared memory block. Returns the block, which the parent
+    # must keep (and close/unlink at the end), and a small picklable handle for attach_grammar
+    grammar = get_grammar(grammar)
+    int_bytes = bytes(grammar.buffer)
+    meta = json.dumps({'name': grammar.name, 'gram': grammar.gram, 'hash': grammar.hash, 'lhs': grammar.lhs,
+                       'rhs': grammar.rhs, 'terminals': grammar.terminals, 'layout': grammar.layout}).encode('utf-8')
+    shm = shared_memory.SharedMemory(create=True, size=len(int_bytes) + len(meta))
+    shm.buf[:len(int_bytes)] = int_bytes
+    shm.buf[len(int_bytes):len(int_bytes) + len(meta)] = meta
+    return shm, (shm.name, len(int_bytes), len(meta))
+
+
+def attach_grammar(handle):
+    # Attach to a block created by share_grammar and register the grammar it holds, so that
+    # get_grammar(name) in this process uses the shared tables. Usable as a Pool initializer
+    shm_name, int_nbytes, meta_nbytes = handle
+    if sys.version_info >= (3, 13):
+        # Only the creating process owns (and unlinks) the block
+        shm = shared_memory.SharedMemory(name=shm_name, track=False)
+    else:
+        # Worker processes share the resource tracker of their parent, which already tracks the block
+        shm = shared_memory.SharedMemory(name=shm_name)
+    meta = json.loads(bytes(shm.buf[int_nbytes:int_nbytes + meta_nbytes]).decode('utf-8'))
+    rhs = [tuple((symbol, is_nonterminal) for symbol, is_nonterminal in r) for r in meta['rhs']]
+    layout = {name: tuple(item) for name, item in meta['layout'].items()}
+    grammar = GrammarTables(meta['name'], meta['gram'], meta['hash'], meta['lhs'], rhs, meta['terminals'],
+                            buffer=shm.buf[:int_nbytes], layout=layout)
+    # Keep the mapping alive as long as the grammar is used
+    grammar._shm = shm
+    _registry[(grammar.name, grammar.hash)] = grammar
+    _latest[grammar.name] = grammar
+    return grammar
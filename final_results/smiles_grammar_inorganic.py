@@ -1,5 +1,3 @@
-import nltk
-
 # Enhanced SMILES grammar to handle complex metal coordination environments, nested aromatic systems, and extended ring handling
 gram = """
 smiles -> chain
@@ -116,4 +114,12 @@ Nothing -> None
 """
 
 # Form the CFG and get the start symbol
-GCFG = nltk.CFG.fromstring(gram)
+# GCFG is built on first access, so that importing the grammar does not import nltk
+# (decoding uses the cached tables from grammar_tables instead)
+def __getattr__(name):
+    if name == 'GCFG':
+        import nltk
+        global GCFG
+        GCFG = nltk.CFG.fromstring(gram)
+        return GCFG
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,144 @@
+# Linear-time structural checks on SMILES strings, used to discard hopeless children
+# before they reach RDKit or CCDC. Only errors that the toolkits always reject are reported:
+# unbalanced parentheses, unmatched ring closures and malformed bracket atoms. Charges are not range-checked,
+# RDKit accepts any magnitude ([N-21], [CH4+16]).
+# The reasons are short fixed strings, so they can be counted directly.
+import re
+
+ELEMENTS = (
+    'H He Li Be B C N O F Ne Na Mg Al Si P S Cl Ar K Ca Sc Ti V Cr Mn Fe Co Ni Cu Zn Ga Ge As Se Br Kr '
+    'Rb Sr Y Zr Nb Mo Tc Ru Rh Pd Ag Cd In Sn Sb Te I Xe Cs Ba La Ce Pr Nd Pm Sm Eu Gd Tb Dy Ho Er Tm Yb '
+    'Lu Hf Ta W Re Os Ir Pt Au Hg Tl Pb Bi Po At Rn Fr Ra Ac Th Pa U Np Pu Am Cm Bk Cf Es Fm Md No Lr'
+).split()
+ATOMIC_NUMBER = {symbol: z for z, symbol in enumerate(ELEMENTS, start=1)}
+AROMATIC_SYMBOLS = {'b', 'c', 'n', 'o', 'p', 's', 'se', 'as', 'te'}
+
+# Most bonds an atom can take, used by valence-aware decoding: the highest valence accepted for main-group
+# elements (hypervalent states included), the neighbours of aromatic atoms and the bonds written to metal
+# centres (DEFAULT_COORDINATION for the metals not listed). CSD SMILES bond every atom of a hapto ligand to the
+# metal, so a metallocene iron takes 10 bonds and a sandwich of two arenes 12
+MAX_VALENCE = {'H': 1, 'B': 3, 'C': 4, 'N': 3, 'O': 2, 'F': 1, 'Al': 3, 'Si': 4, 'P': 5, 'S': 6, 'Cl': 1,
+               'Ga': 3, 'Ge': 4, 'As': 5, 'Se': 6, 'Br': 1, 'In': 3, 'Sn': 4, 'Sb': 5, 'Te': 6, 'I': 3,
+               'Tl': 3, 'Pb': 4, 'Bi': 5}
+AROMATIC_VALENCE = {'b': 3, 'c': 3, 'n': 3, 'o': 2, 'p': 3, 's': 2, 'se': 2, 'as': 3, 'te': 2}
+MAIN_GROUP = {'B': 13, 'Al': 13, 'Ga': 13, 'In': 13, 'Tl': 13, 'C': 14, 'Si': 14, 'Ge': 14, 'Sn': 14, 'Pb': 14,
+              'N': 15, 'P': 15, 'As': 15, 'Sb': 15, 'Bi': 15, 'O': 16, 'S': 16, 'Se': 16, 'Te': 16,
+              'F': 17, 'Cl': 17, 'Br': 17, 'I': 17}
+# Valence of hypervalent halogens, only written in brackets (perchlorate O=[Cl](=O)(=O)O)
+BRACKET_VALENCE = {'Cl': 7, 'Br': 7, 'I': 7}
+# Formal charge CSD-style SMILES leave out on donor atoms (C#O, N#O ligands)
+DONOR_CHARGE = {'N': 1, 'P': 1, 'As': 1, 'O': 1, 'S': 1, 'Se': 1, 'Te': 1}
+DEFAULT_COORDINATION = 12
+MAX_COORDINATION = {'Li': 8, 'Be': 8,
+                    'Ba': 16, 'La': 16, 'Ce': 16, 'Pr': 16, 'Nd': 16, 'Pm': 16, 'Sm': 16, 'Eu': 16, 'Gd': 16,
+                    'Tb': 16, 'Dy': 16, 'Ho': 16, 'Er': 16, 'Tm': 16, 'Yb': 16, 'Lu': 16,
+                    'Th': 16, 'Pa': 16, 'U': 16, 'Np': 16, 'Pu': 16, 'Am': 16, 'Cm': 16, 'Bk': 16, 'Cf': 16}
+
+BRACKET_ATOM = re.compile(r'(?P<isotope>\d+)?(?P<symbol>[A-Z][a-z]?|[a-z][a-z]?)(?P<chiral>@@?)?'
+                          r'(?:H(?P<hcount>\d*))?(?P<charge>\++|-+|[+-]\d+)?(?::\d+)?$')
+
+
+def bracket_atom_error(content):
+    match = BRACKET_ATOM.match(content)
+    if match is None:
+        return 'invalid bracket atom'
+    symbol = match.group('symbol')
+    if symbol[0].islower():
+        if symbol not in AROMATIC_SYMBOLS:
+            return 'unknown aromatic symbol'
+        element = symbol.capitalize()
+    else:
+        element = symbol
+    if element not in ATOMIC_NUMBER:
+        return 'unknown element'
+    return None
+
+
+def smiles_error(smiles):
+    # Returns the reason why the SMILES cannot be valid, or None if no structural error was found
+    if not smiles:
+        return 'empty SMILES'
+
+    n = len(smiles)
+    i = 0
+    atom = -1  # index of the current atom, -1 before the first one
+    n_atoms = 0
+    branches = []
+    open_rings = {}
+    while i < n:
+        ch = smiles[i]
+        if ch == '[':
+            end = smiles.find(']', i + 1)
+            if end < 0:
+                return 'unclosed bracket atom'
+            error = bracket_atom_error(smiles[i + 1:end])
+            if error is not None:
+                return error
+            atom = n_atoms
+            n_atoms += 1
+            i = end + 1
+            continue
+        if ch == ']':
+            return 'unmatched ]'
+        if ch.isalpha():
+            atom = n_atoms
+            n_atoms += 1
+        elif ch == '(':
+            if atom < 0:
+                return 'branch before the first atom'
+            branches.append(atom)
+        elif ch == ')':
+            if not branches:
+                return 'unmatched )'
+            atom = branches.pop()
+        elif ch.isdigit() or ch == '%':
+            if ch == '%':
+                label = smiles[i + 1:i + 3]
+                if len(label) != 2 or not label.isdigit():
+                    return 'invalid % ring closure'
+                i += 2
+            else:
+                label = ch
+            if atom < 0:
+                return 'ring closure before the first atom'
+            if label in open_rings:
+                if open_rings.pop(label) == atom:
+                    return 'ring closure bonds an atom to itself'
+            else:
+                open_rings[label] = atom
+        elif ch == '.':
+            atom = -1
+        elif ch not in '-=#$:/\\':
+            return 'unexpected character'
+        i += 1
+
+    if branches:
+        return 'unclosed branch'
+    if open_rings:
+        return 'unclosed ring closure'
+    if n_atoms == 0:
+        return 'no atoms'
+    return None
+
+
+def max_bonds(symbol, aromatic=False, metal=False, charge=0, bracketed=False):
+    # Total bond order (hydrogens included) an atom can take. A charge shifts a main-group element to the
+    # valence of its isoelectronic neighbour: N+ and B- take 4, O- takes 1. Metal centres ignore charges
+    if metal:
+        return MAX_COORDINATION.get(symbol, DEFAULT_COORDINATION)
+    if aromatic:
+        return max(AROMATIC_VALENCE.get(symbol, 3) + charge, 0)
+    valence = BRACKET_VALENCE.get(symbol) if bracketed and symbol in BRACKET_VALENCE else \
+        MAX_VALENCE.get(symbol, DEFAULT_COORDINATION)
+    group = MAIN_GROUP.get(symbol)
+    if group is None or not charge:
+        return valence
+    if group == 13:
+        return max(valence - charge, 0)
+    if group == 14:
+        return max(valence - abs(charge), 0)
+    return max(valence + charge, 0)
+
+
+def is_plausible_smiles(smiles):
+    return smiles_error(smiles) is None
@@ -2,20 +2,39 @@ import time
 import copy
 import multiprocessing
 import traceback
+from collections import Counter
 from rdkit import Chem
 
-# Switch to use the appropriate codebase
+# Switch to use the appropriate grammar (both are served by the same cfg_util through the grammar registry)
 original_code = False
-if original_code:
-    from original_code.smiles_grammar import GCFG
-else:    
-    from smiles_grammar_inorganic import GCFG
-
+GRAMMAR = 'organic' if original_code else 'inorganic'
+# Ring-closure-aware decoding: mutants never keep unmatched ring bonds
+close_rings = False
+# Finish derivations cut short by the gene with the shortest expansions, so no mutant decodes to ''
+complete = False
+# Enumerate every distinct single-codon mutant once, weighted by its probability, instead of sampling n_attempts.
+# This trades speed for exactness: it is slower than sampling, since every distinct mutant is decoded and
+# validated (several hundred toolkit checks per molecule instead of at most n_attempts)
+exact = False
+# Codon table learned by production_frequencies.py (None: every alternative equally likely)
+codon_table_file = None
+# Valence-aware decoding: bonds, hydrogen counts, ring bonds and branches stay within the valence of every atom
+valence = False
+
+import final_results_path
 from cfg_util import *
-from GOs import mutation
-
-# Function to process a batch of SMILES strings
-def process_smiles_batch(smiles_batch, n_attempts, results_queue):
+from GOs import mutation, mutation_outcomes
+from scheduling import make_task_queue, iter_tasks
+from smiles_validation import smiles_error
+from grammar_tables import share_grammar, attach_grammar
+
+# Function to process the SMILES taken from the shared task queue
+def process_smiles_batch(task_queue, n_attempts, results_queue, grammar_handle=None):
+    # Use the grammar tables shared by the parent process
+    grammar = attach_grammar(grammar_handle) if grammar_handle is not None else GRAMMAR
+    codon_table = CodonTable.load(codon_table_file, grammar) if codon_table_file is not None else None
+    # Mutants sharing their effective gene (gene_key) with an earlier one are not decoded again
+    decode_cache = DecodeCache()
     # Initializing counts for different types of success and failures
     n_success = 0
     n_unchanged = 0
@@ -25,55 +44,80 @@ def process_smiles_batch(smiles_batch, n_attempts, results_queue):
     encoding_failures = 0
     mutation_failures = 0
     decoding_failures = 0
+    n_prefiltered = 0
+    prefilter_reasons = Counter()
 
-    for smiles in smiles_batch:
+    for smiles in iter_tasks(task_queue):
         # Encode the SMILES and convert to gene
         try:
-            encoded_smiles = encode(smiles)
-            gene = cfg_to_gene(encoded_smiles, max_len=-1)
+            encoded_smiles = encode(smiles, grammar=grammar)
+            gene = cfg_to_gene(encoded_smiles, max_len=-1, grammar=grammar, codon_table=codon_table)
         except Exception as e:
             encoding_failures += 1
             print(f"Encoding Failure: {smiles}")
             print(traceback.format_exc())
             continue
 
-        for _ in range(n_attempts):
+        if exact:
             try:
-                # MUTATION STEP
-                mutated_gene = mutation(gene)
+                outcomes = mutation_outcomes(gene, grammar=grammar, close_rings=close_rings, complete=complete,
+                                             codon_table=codon_table, valence=valence)
             except Exception as e:
-                mutation_failures += 1
-                print(f"Mutation Failure: Gene - {gene}")
+                decoding_failures += n_attempts
+                print(f"Decoding Failure: Gene - {gene}")
                 print(traceback.format_exc())
                 continue
+            # Expected counts over n_attempts mutations, every distinct SMILES is checked once
+            attempts = [(new_smiles, p * n_attempts) for new_smiles, p in outcomes.items()]
+        else:
+            mutated_genes = []
+            for _ in range(n_attempts):
+                try:
+                    # MUTATION STEP
+                    mutated_genes.append(mutation(gene))
+                except Exception as e:
+                    mutation_failures += 1
+                    print(f"Mutation Failure: Gene - {gene}")
+                    print(traceback.format_exc())
 
             try:
-                # DECODING STEP
-                mutated_decoded_smiles = gene_to_cfg(mutated_gene)
-                new_smiles = decode(mutated_decoded_smiles)
+                # DECODING STEP: all the mutants of the molecule in one batch
+                new_smiles_list = decode_genes(mutated_genes, grammar=grammar, cache=decode_cache,
+                                               close_rings=close_rings, complete=complete, codon_table=codon_table,
+                                               valence=valence)
             except Exception as e:
-                decoding_failures += 1
-                # print(f"Decoding Failure: Mutated Gene - {mutated_gene}")
+                decoding_failures += len(mutated_genes)
+                # print(f"Decoding Failure: Gene - {gene}")
                 # print(traceback.format_exc())
                 continue
+            # Every distinct SMILES is checked once, weighted by the number of mutants that gave it
+            attempts = list(Counter(new_smiles_list).items())
 
+        for new_smiles, weight in attempts:
             # Tracking results
             if new_smiles == smiles:
-                n_unchanged += 1
+                n_unchanged += weight
             elif new_smiles == '':
-                n_failed_empty += 1
+                n_failed_empty += weight
                 # print(f"Empty SMILES: Original Gene - {gene},\n Mutated Gene - {mutated_gene}")
             elif new_smiles is None:
-                decoding_failures += 1
-                n_failed_real_error += 1
+                decoding_failures += weight
+                n_failed_real_error += weight
             elif new_smiles != smiles:
-                n_success += 1
+                n_success += weight
+
+                # Cheap structural check first, hopeless SMILES never reach RDKit
+                reason = smiles_error(new_smiles)
+                if reason is not None:
+                    n_prefiltered += weight
+                    prefilter_reasons[reason] += weight
+                    continue
 
                 # Validity check with rdKit
                 try:
                     mol = Chem.MolFromSmiles(new_smiles)
                     if mol is not None:
-                        n_valid += 1
+                        n_valid += weight
                 except Exception as e:
                     print(f"rdKit Validation Failure: SMILES - {new_smiles}")
                     print(traceback.format_exc())
@@ -88,6 +132,8 @@ def process_smiles_batch(smiles_batch, n_attempts, results_queue):
         'encoding_failures': encoding_failures,
         'mutation_failures': mutation_failures,
         'decoding_failures': decoding_failures,
+        'n_prefiltered': n_prefiltered,
+        'prefilter_reasons': prefilter_reasons,
     })
 
 # Main function to execute multiprocessing
@@ -120,15 +166,16 @@ def main():
     # Create a multiprocessing queue to collect results
     results_queue = multiprocessing.Queue()
 
-    # Start multiprocessing - assign SMILES evenly among processes
-    smiles_per_process = len(valid_smiles) // total_processes
+    # Start multiprocessing - SMILES are handed out most expensive first from a shared queue,
+    # so processes that finish early keep taking work instead of idling
+    task_queue = make_task_queue(valid_smiles, total_processes)
+    # Grammar tables are placed once in shared memory for all processes
+    shm, grammar_handle = share_grammar(GRAMMAR)
     processes = []
 
     for i in range(total_processes):
-        start_idx = i * smiles_per_process
-        end_idx = len(valid_smiles) if i == total_processes - 1 else (i + 1) * smiles_per_process
-        batch = valid_smiles[start_idx:end_idx]
-        p = multiprocessing.Process(target=process_smiles_batch, args=(batch, n_attempts, results_queue))
+        p = multiprocessing.Process(target=process_smiles_batch, args=(task_queue, n_attempts, results_queue),
+                                    kwargs={'grammar_handle': grammar_handle})
         processes.append(p)
         p.start()
 
@@ -141,17 +188,23 @@ def main():
     for p in processes:
         p.join()
 
+    # Release the shared grammar tables
+    shm.close()
+    shm.unlink()
+
     # Aggregate results
-    total_success = sum(result['n_success'] for result in results)
-    total_unchanged = sum(result['n_unchanged'] for result in results)
-    total_failed_empty = sum(result['n_failed_empty'] for result in results)
-    total_failed_real_error = sum(result['n_failed_real_error'] for result in results)
-    total_valid = sum(result['n_valid'] for result in results)
+    total_success = round(sum(result['n_success'] for result in results), 2)
+    total_unchanged = round(sum(result['n_unchanged'] for result in results), 2)
+    total_failed_empty = round(sum(result['n_failed_empty'] for result in results), 2)
+    total_failed_real_error = round(sum(result['n_failed_real_error'] for result in results), 2)
+    total_valid = round(sum(result['n_valid'] for result in results), 2)
     total_processed = len(valid_smiles) * n_attempts
 
     total_encoding_failures = sum(result['encoding_failures'] for result in results)
     total_mutation_failures = sum(result['mutation_failures'] for result in results)
-    total_decoding_failures = sum(result['decoding_failures'] for result in results)
+    total_decoding_failures = round(sum(result['decoding_failures'] for result in results), 2)
+    total_prefiltered = round(sum(result['n_prefiltered'] for result in results), 2)
+    prefilter_reasons = sum((result['prefilter_reasons'] for result in results), Counter())
 
     # Print overall analysis
     print("\nOverall Analysis:")
@@ -166,6 +219,9 @@ def main():
     print(f'Total Encoding Failures: {total_encoding_failures}')
     print(f'Total Mutation Failures: {total_mutation_failures}')
     print(f'Total Decoding Failures: {total_decoding_failures}')
+    print(f'Total SMILES rejected before RDKit: {total_prefiltered}')
+    for reason, count in prefilter_reasons.most_common():
+        print(f'    {reason}: {count}')
     print(f'Time taken: {time.time() - start_time:.2f} seconds')
 
 if __name__ == '__main__':
@@ -0,0 +1,122 @@
+# Array-backed storage of the per-SMILES timings produced by inorg_complexity_investigation.py
+# The raw elapsed time and outcome of every SMILES are kept, so histograms, percentiles and
+# the old 'final_range_*' files can be rebuilt at any time without re-running the encodings.
+import numpy as np
+
+# Outcome codes stored in the status array
+SUCCESS = 0
+FAILURE = 1
+TIMEOUT = 2
+MEMORY = 3
+
+STATUS_NAMES = {SUCCESS: 'success', FAILURE: 'failure', TIMEOUT: 'timeout', MEMORY: 'memory'}
+
+
+class ComplexityResults:
+
+    def __init__(self, smiles, elapsed=None, status=None, chart_edges=None, peak_bytes=None):
+        self.smiles = np.asarray(smiles, dtype=object)
+        n = len(self.smiles)
+        # Elapsed time in seconds (NaN when the SMILES failed before finishing)
+        self.elapsed = np.full(n, np.nan) if elapsed is None else np.asarray(elapsed, dtype=float)
+        self.status = np.full(n, FAILURE, dtype=np.int8) if status is None else np.asarray(status, dtype=np.int8)
+        # Peak size of the parser chart, in edges and in bytes
+        self.chart_edges = np.zeros(n, dtype=np.int64) if chart_edges is None else np.asarray(chart_edges, dtype=np.int64)
+        self.peak_bytes = np.zeros(n, dtype=np.int64) if peak_bytes is None else np.asarray(peak_bytes, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.smiles)
+
+    def record(self, idx, elapsed, status, chart_edges=0, peak_bytes=0):
+        self.elapsed[idx] = np.nan if elapsed is None else elapsed
+        self.status[idx] = status
+        self.chart_edges[idx] = chart_edges
+        self.peak_bytes[idx] = peak_bytes
+
+    def save(self, file_name):
+        np.savez_compressed(file_name, smiles=self.smiles.astype(str), elapsed=self.elapsed, status=self.status,
+                            chart_edges=self.chart_edges, peak_bytes=self.peak_bytes)
+
+    @classmethod
+    def load(cls, file_name):
+        data = np.load(file_name)
+        # Files saved before memory tracking was added have no chart arrays
+        chart_edges = data['chart_edges'] if 'chart_edges' in data.files else None
+        peak_bytes = data['peak_bytes'] if 'peak_bytes' in data.files else None
+        return cls(data['smiles'].tolist(), data['elapsed'], data['status'], chart_edges, peak_bytes)
+
+    def mask(self, status):
+        return self.status == status
+
+    def counts(self):
+        return {name: int(np.sum(self.status == code)) for code, name in STATUS_NAMES.items()}
+
+    def histogram(self, bins):
+        # bins is either a list of edges or a list of (start, end) tuples like the old TIME_RANGES
+        if len(bins) and isinstance(bins[0], tuple):
+            edges = [start for start, _ in bins] + [bins[-1][1]]
+        else:
+            edges = list(bins)
+        counts, edges = np.histogram(self.elapsed[self.mask(SUCCESS)], bins=edges)
+        return counts, edges
+
+    def percentiles(self, q=(50, 90, 99, 100)):
+        times = self.elapsed[self.mask(SUCCESS)]
+        if len(times) == 0:
+            return {p: np.nan for p in q}
+        return dict(zip(q, np.percentile(times, q)))
+
+    def memory_percentiles(self, q=(50, 90, 99, 100)):
+        # Peak chart bytes of every SMILES that reached the parser, including aborted ones
+        peaks = self.peak_bytes[self.peak_bytes > 0]
+        if len(peaks) == 0:
+            return {p: np.nan for p in q}
+        return dict(zip(q, np.percentile(peaks, q)))
+
+    def smiles_in_range(self, start, end):
+        selected = self.mask(SUCCESS) & (self.elapsed >= start) & (self.elapsed < end)
+        return self.smiles[selected].tolist()
+
+    def export_ranges(self, time_ranges, max_time, prefix='final'):
+        # Write the same files the previous tempfile-based version produced
+        for start, end in time_ranges:
+            with open(f'{prefix}_range_{start}_{end}.txt', 'a') as f:
+                f.writelines(s + '\n' for s in self.smiles_in_range(start, end))
+        slow = self.mask(TIMEOUT) | (self.mask(SUCCESS) & (self.elapsed >= max_time))
+        with open(f'{prefix}_range_greater_than_{max_time}.txt', 'a') as f:
+            f.writelines(s + '\n' for s in self.smiles[slow])
+        with open(f'{prefix}_failures.txt', 'a') as f:
+            f.writelines(s + '\n' for s in self.smiles[self.mask(FAILURE)])
+        with open(f'{prefix}_memory_limit.txt', 'a') as f:
+            f.writelines(s + '\n' for s in self.smiles[self.mask(MEMORY)])
+
+    def compare(self, other):
+        # Compare two runs (e.g. two grammar versions) on the SMILES they have in common
+        other_index = {s: i for i, s in enumerate(other.smiles)}
+        idx_self, idx_other = [], []
+        for i, s in enumerate(self.smiles):
+            j = other_index.get(s)
+            if j is not None:
+                idx_self.append(i)
+                idx_other.append(j)
+        idx_self, idx_other = np.array(idx_self, dtype=int), np.array(idx_other, dtype=int)
+        status_a, status_b = self.status[idx_self], other.status[idx_other]
+        both = (status_a == SUCCESS) & (status_b == SUCCESS)
+        ratio = other.elapsed[idx_other][both] / np.maximum(self.elapsed[idx_self][both], 1e-9)
+        return {
+            'n_common': len(idx_self),
+            'n_both_success': int(np.sum(both)),
+            'n_fixed': int(np.sum((status_a != SUCCESS) & (status_b == SUCCESS))),
+            'n_broken': int(np.sum((status_a == SUCCESS) & (status_b != SUCCESS))),
+            'median_time_ratio': float(np.median(ratio)) if len(ratio) else np.nan,
+        }
+
+
+def adaptive_chunksize(per_item_cost, n_items, n_processes, target_chunk_time=2.0):
+    # Large enough to amortise the IPC cost of cheap SMILES, small enough
+    # that every process still gets several chunks to balance the load
+    if n_items == 0:
+        return 1
+    by_cost = int(target_chunk_time / max(per_item_cost, 1e-6))
+    by_balance = n_items // (4 * n_processes)
+    return max(1, min(by_cost, by_balance))
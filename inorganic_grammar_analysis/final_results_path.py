@@ -0,0 +1,9 @@
+# The grammar modules (cfg_util, GOs, grammar_tables, smiles_validation...) have a single copy, in final_results.
+# Importing this module first puts that directory on sys.path for the scripts of this directory
+import os
+import sys
+
+FINAL_RESULTS_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                                  'final_results'))
+if FINAL_RESULTS_DIR not in sys.path:
+    sys.path.insert(0, FINAL_RESULTS_DIR)
@@ -0,0 +1,72 @@
+# Learn how often every production of the grammar is used by a corpus of SMILES, and save the CodonTable
+# that maps codon values to productions in proportion to these frequencies.
+# The table is then used by gene_to_cfg(..., codon_table=CodonTable.load(TABLE_FILE)) and by the mutation
+# efficiency analyses (codon_table_file switch), so that mutations mostly pick productions seen in real molecules
+import time
+import multiprocessing
+import final_results_path
+from cfg_util import *
+from grammar_tables import share_grammar, attach_grammar
+
+GRAMMAR = 'inorganic'
+ENCODING_TIME_LIMIT = 2  # seconds per SMILES, slower ones are skipped
+TABLE_FILE = f'codon_table_{GRAMMAR}.json'
+
+grammar = None
+
+
+def init_worker(handle):
+    global grammar
+    grammar = attach_grammar(handle)
+
+
+def encode_smiles(smiles):
+    # Production indices of the SMILES, or None if it cannot be encoded in time
+    try:
+        return list(encode(smiles, deadline=time.monotonic() + ENCODING_TIME_LIMIT, grammar=grammar))
+    except Exception:
+        return None
+
+
+def print_summary(table, top=5):
+    grammar = table.grammar
+    print(f"\n{'Nonterminal':<25}{'Most frequent alternatives (share of codon values)'}")
+    print("-" * 100)
+    for n, symbol in enumerate(grammar.nonterminals):
+        alternatives = grammar.choice_rules[grammar.choice_offsets[n]:grammar.choice_offsets[n + 1]]
+        if len(alternatives) < 2:
+            continue
+        alternatives = sorted(alternatives, key=lambda r: table.n_codons[r], reverse=True)[:top]
+        shares = ', '.join(f"{' '.join(s for s, _ in grammar.rhs[r])} {table.n_codons[r] / table.n_values:.2f}"
+                           for r in alternatives)
+        print(f"{symbol:<25}{shares}")
+
+
+def main():
+    start = time.time()
+    smiles_file = 'smiles_inorganic.smi'
+    total_processes = 8
+
+    with open(smiles_file, 'r') as f:
+        smiles_list = [smiles.strip() for smiles in f if smiles.strip()]
+
+    shm, handle = share_grammar(GRAMMAR)
+    try:
+        with multiprocessing.Pool(processes=total_processes, initializer=init_worker, initargs=(handle,)) as pool:
+            encoded = [e for e in pool.imap(encode_smiles, smiles_list, chunksize=64) if e is not None]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    counts = count_productions(encoded, grammar=GRAMMAR)
+    table = CodonTable(counts, grammar=GRAMMAR)
+    table.save(TABLE_FILE)
+
+    print(f'Encoded {len(encoded)} of {len(smiles_list)} SMILES, {sum(counts)} productions counted')
+    print_summary(table)
+    print(f'Codon table saved to {TABLE_FILE}')
+    print(f"{'Total Time taken for program execution':<60}{time.time() - start:.2f} seconds")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# Cost-aware scheduling of SMILES over worker processes
+# Encoding time ranges from milliseconds to tens of seconds, so equal contiguous slices leave one process
+# running long after the others. Instead every SMILES is put on a shared queue, most expensive first,
+# and idle workers keep taking the next one (longest-processing-time-first with work stealing).
+import re
+import multiprocessing
+
+import final_results_path
+from smiles_grammar_inorganic import gram
+
+METALS = set(re.findall(r"'(\w+)'", re.search(r'^metal_symbol ->(.*)$', gram, re.M).group(1)))
+
+BRACKET_ATOM = re.compile(r'\[\d*([A-Z][a-z]?)')
+RING_CLOSURE = re.compile(r'%\d\d|\d')
+
+
+def estimate_cost(smiles):
+    # Relative encoding cost, only used to order the work: the chart parser is roughly cubic in
+    # the number of tokens, and ring closures and metal centres make the parse more ambiguous
+    length = len(smiles)
+    outside_brackets = re.sub(r'\[[^\]]*\]', '', smiles)
+    n_ring_closures = len(RING_CLOSURE.findall(outside_brackets))
+    n_metals = sum(1 for symbol in BRACKET_ATOM.findall(smiles) if symbol in METALS)
+    return length ** 3 * (1 + 0.05 * n_ring_closures) * (1 + 0.25 * n_metals)
+
+
+def order_by_cost(smiles_list):
+    return sorted(smiles_list, key=estimate_cost, reverse=True)
+
+
+def make_task_queue(smiles_list, n_workers):
+    # Largest-first queue shared by all workers, with one stop sentinel per worker
+    task_queue = multiprocessing.Queue()
+    for smiles in order_by_cost(smiles_list):
+        task_queue.put(smiles)
+    for _ in range(n_workers):
+        task_queue.put(None)
+    return task_queue
+
+
+def iter_tasks(task_queue):
+    # Used inside a worker: yield SMILES until the stop sentinel is reached
+    while True:
+        smiles = task_queue.get()
+        if smiles is None:
+            return
+        yield smiles
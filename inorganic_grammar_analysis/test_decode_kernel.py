@@ -0,0 +1,54 @@
+# Script to check that the batch decoding kernels (decode_kernel) give the same SMILES as gene_to_cfg + decode,
+# and to time both on a population of mutants. The kernels are compiled when numba is installed, otherwise
+# they run as plain Python (slow, but the output must be the same)
+
+import final_results_path
+from cfg_util import *
+from GOs import mutation
+import decode_kernel
+import numpy as np
+import time
+
+np.random.seed(0)
+population_size = 2000
+
+smiles_list = [
+    'CC(c1c(CC)cc(C=O)cc1)(CC(CO)CC)',
+    'CC(=O)OCC[N+](C)(C)C',
+    'Cl[Ru](C#O)([Si](Cl)(Cl)Cl)([P](C1CCCCC1)(C1CCCCC1)C1CCCCC1)[Si-](Cl)(Cl)Cl',
+    'O=[Fe+]123N4=C(CN1(CC1=N2C(=CNC2CCCCC2)C=C1)CC1=N3C(=CNC2CCCCC2)C=C1)C=CC4=CNC1CCCCC1',
+]
+
+for grammar in ('inorganic', 'organic'):
+    tables = get_grammar(grammar)
+    genes = []
+    for smiles in smiles_list:
+        try:
+            gene = cfg_to_gene(encode(smiles, grammar=grammar), max_len=-1, grammar=grammar)
+        except Exception:
+            # Not every SMILES is in both grammars
+            continue
+        genes.append(gene)
+        genes += [mutation(gene) for _ in range(population_size // len(smiles_list))]
+    # Random genes of different lengths, mostly unfinished derivations
+    genes += [list(np.random.randint(0, 256, size=np.random.randint(1, 300))) for _ in range(population_size // 4)]
+
+    start = time.time()
+    expected = [decode(gene_to_cfg(gene, grammar=grammar), grammar=grammar) for gene in genes]
+    python_time = time.time() - start
+
+    # First call compiles the kernels
+    decode_kernel.decode_population(genes[:1], tables)
+    start = time.time()
+    decoded = decode_kernel.decode_population(genes, tables)
+    kernel_time = time.time() - start
+
+    mismatches = [i for i, (a, b) in enumerate(zip(expected, decoded)) if a != b]
+    print(f'{grammar}: {len(genes)} genes, {len(mismatches)} mismatches, '
+          f'{sum(1 for s in expected if s)} complete derivations')
+    for i in mismatches[:5]:
+        print(f'    Gene: {genes[i]}\n    Python: {expected[i]}\n    Kernel: {decoded[i]}')
+    assert not mismatches
+    assert decode_genes(genes, grammar=grammar) == expected
+    print(f'    Python: {python_time:.3f} seconds, kernel (numba {decode_kernel.JIT_AVAILABLE}): '
+          f'{kernel_time:.3f} seconds, speed-up {python_time / kernel_time:.1f}x')
@@ -1,36 +1,30 @@
-import signal
 import time
 import multiprocessing
+import final_results_path
 from cfg_util import *
 from smiles_grammar_inorganic import GCFG
 import numpy as np
+from scheduling import make_task_queue, iter_tasks
+from grammar_tables import share_grammar, attach_grammar
 
-# Define a timeout handler
-class TimeoutException(Exception):
-    pass
-
-def timeout_handler(signum, frame):
-    raise TimeoutException
-
-# Set the signal handler for alarm
-signal.signal(signal.SIGALRM, timeout_handler)
-
-# Function to process a batch of SMILES strings
-def process_smiles_batch(batch_index, smiles_batch, time_limit, results_queue):
+# Function to process the SMILES taken from the shared task queue
+def process_smiles_batch(batch_index, task_queue, time_limit, results_queue, grammar_handle):
+    # Use the grammar tables shared by the parent process
+    attach_grammar(grammar_handle)
     start = time.time()
     n_changed, n_failed, n_success, n_timeout = 0, 0, 0, 0
     failed, success, timeout_smiles = [], [], []
 
-    for smiles in smiles_batch:
+    for smiles in iter_tasks(task_queue):
         start_partial = time.time()
         
-        # Set an alarm for the time limit
-        signal.alarm(time_limit)
-        
+        # Timeouts are checked cooperatively inside encode/decode
+        deadline = time.monotonic() + time_limit
+
         try:
             # Attempt to encode and decode the SMILES
             # Encoding
-            encoded_smiles = encode(smiles)
+            encoded_smiles = encode(smiles, deadline=deadline)
             if encoded_smiles is None:
                 raise ValueError("Encoding failed")
 
@@ -38,10 +32,10 @@ def process_smiles_batch(batch_index, smiles_batch, time_limit, results_queue):
             gene = cfg_to_gene(encoded_smiles, max_len=-1)
 
             # From gene to decoded smiles
-            decoded_smiles = gene_to_cfg(gene)
+            decoded_smiles = gene_to_cfg(gene, deadline=deadline)
 
             # Decoding (from decoded smiles back to smiles)
-            final_smiles = decode(decoded_smiles)
+            final_smiles = decode(decoded_smiles, deadline=deadline)
 
             # Check if the final smiles is the same as the original smiles
             if smiles == final_smiles:
@@ -59,9 +53,6 @@ def process_smiles_batch(batch_index, smiles_batch, time_limit, results_queue):
             # Handle any other exceptions silently
             n_failed += 1
             failed.append(smiles)
-        finally:
-            # Disable the alarm
-            signal.alarm(0)
 
     # Record results in the queue for each batch
     results_queue.put({
@@ -94,14 +85,18 @@ def main():
     remaining_smiles = smiles_list[start_index:]
     total_batches = min(total_processes, len(remaining_smiles) // batch_size)
 
-    batches = [remaining_smiles[i * batch_size: (i + 1) * batch_size] for i in range(total_batches)]
+    # The selected SMILES are shared through one queue, most expensive first, instead of fixed batches
+    selected_smiles = remaining_smiles[:total_batches * batch_size]
+    task_queue = make_task_queue(selected_smiles, total_batches)
+    # Grammar tables are placed once in shared memory for all processes
+    shm, grammar_handle = share_grammar()
     processes = []
     results_queue = multiprocessing.Queue()
 
     # Start each process
     print(f'Starting {total_processes} processes...')
-    for i, batch in enumerate(batches):
-        p = multiprocessing.Process(target=process_smiles_batch, args=(i, batch, time_limit, results_queue))
+    for i in range(total_batches):
+        p = multiprocessing.Process(target=process_smiles_batch, args=(i, task_queue, time_limit, results_queue, grammar_handle))
         processes.append(p)
         p.start()
 
@@ -115,6 +110,10 @@ def main():
     for p in processes:
         p.join()
 
+    # Release the shared grammar tables
+    shm.close()
+    shm.unlink()
+
     # Aggregate results and save them
     total_success = sum(result['n_success'] for result in results)
     total_failed = sum(result['n_failed'] for result in results)
@@ -1,5 +1,6 @@
 # Script to test the correct process of encoding a smiles into a gene and decoding it back to a smiles
 
+import final_results_path
 from cfg_util import *
 from deprecated.smiles_grammar_new import GCFG
 from GOs import mutation
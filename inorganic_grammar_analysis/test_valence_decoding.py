@@ -0,0 +1,55 @@
+# Script to check that valence-aware decoding leaves valid molecules alone: the gene of an encoded SMILES
+# must decode back to the same SMILES with valence=True, and its single-codon mutants must give the original
+# SMILES at least as often as with plain decoding (mutations to a forbidden production can be repaired back)
+
+import final_results_path
+from cfg_util import *
+from GOs import mutation_outcomes
+
+smiles_lists = {
+    'inorganic': [
+        'CC(c1c(CC)cc(C=O)cc1)(CC(CO)CC)',
+        'CC(=O)OCC[N+](C)(C)C',
+        'Cl[Ru](C#O)([Si](Cl)(Cl)Cl)([P](C1CCCCC1)(C1CCCCC1)C1CCCCC1)[Si-](Cl)(Cl)Cl',
+        'O#C[Fe]1234(C#O)(C#CC5=CC=CC6=NSN=C56)c5c1c2c3c45',
+        'O#C[Mo]123456(C=C71=C[Mo]189%1027(C#O)(C#O)c2c1c8c9c%102)(C#O)c1c3c4c5c61',
+        'O=[Cl](=O)(=O)O[Zn+]123N4=C(CN1(CC1=N2C(=CNC2CCCCC2)C=C1)CC1=N3C(=CNC2CCCCC2)C=C1)C=CC4=CNC1CCCCC1',
+        'O=[Fe+]123N4=C(CN1(CC1=N2C(=CNC2CCCCC2)C=C1)CC1=N3C(=CNC2CCCCC2)C=C1)C=CC4=CNC1CCCCC1',
+        'c1cc(ccc1C=Cc12c3c4c5c1[Fe]16782345c2c1c6c7c82)C=Cc12c3c4c5c1[Fe]16782345c2c1c6c7c82',
+        'O#C[Mn](C#O)(C#O)(C#O)C#O',
+        'O#C[Co]',
+        '[NH4+]',
+        '[OH3+]',
+        '[PH4+]',
+        '[BH4-]',
+    ],
+    'organic': [
+        'CC(c1c(CC)cc(C=O)cc1)(CC(CO)CC)',
+        'CC(=O)OCC[N+](C)(C)C',
+        'O=C(O)c1ccccc1OC(C)=O',
+        'CN1C=NC2=C1C(=O)N(C)C(=O)N2C',
+        'C[NH3+]',
+        '[NH4+]',
+        '[OH3+]',
+        '[BH4-]',
+    ],
+}
+
+n_failures = 0
+for grammar, smiles_list in smiles_lists.items():
+    for smiles in smiles_list:
+        gene = cfg_to_gene(encode(smiles, grammar=grammar), max_len=-1, grammar=grammar)
+        decoded = decode(gene_to_cfg(gene, grammar=grammar, valence=True), grammar=grammar)
+        if decoded != smiles:
+            n_failures += 1
+            print(f'{grammar}: {smiles} decoded as {decoded}')
+            continue
+        plain = mutation_outcomes(gene, grammar=grammar).get(smiles, 0)
+        valence = mutation_outcomes(gene, grammar=grammar, valence=True).get(smiles, 0)
+        if valence < plain - 1e-9:
+            n_failures += 1
+            print(f'{grammar}: {smiles} unchanged by {valence:.3f} of the mutations ({plain:.3f} without valence)')
+    print(f'{grammar}: {len(smiles_list)} SMILES checked')
+
+print(f'Failures: {n_failures}')
+assert n_failures == 0
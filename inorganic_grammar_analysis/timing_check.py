@@ -1,4 +1,5 @@
 import time
+import final_results_path
 from cfg_util import *
 from smiles_grammar_inorganic import GCFG
 import numpy as np
@@ -1,9 +1,12 @@
 import time
 import os
 import multiprocessing
+import final_results_path
 from cfg_util import *
 from smiles_grammar_inorganic import GCFG
 import numpy as np
+from scheduling import make_task_queue, iter_tasks
+from grammar_tables import share_grammar, attach_grammar
 
 start_general = time.time()
 
@@ -35,9 +38,11 @@ def process_smiles(smiles):
     time_taken = time.time() - start
     return smiles, time_taken
 
-def process_smiles_worker(smiles_list, time_range, result_queue):
+def process_smiles_worker(task_queue, time_range, result_queue, grammar_handle):
+    # Use the grammar tables shared by the parent process
+    attach_grammar(grammar_handle)
     results = []
-    for smiles in smiles_list:
+    for smiles in iter_tasks(task_queue):
         processed_smiles, time_taken = process_smiles(smiles)
         if time_taken is not None:
             if time_taken < time_range[0]:
@@ -61,17 +66,18 @@ def main():
 
     # Use multiprocessing
     total_processes = multiprocessing.cpu_count()  # Utilize all available CPU cores
-    chunk_size = len(smiles_list) // total_processes
 
-    # Split the SMILES list into chunks for parallel processing
-    chunks = [smiles_list[i:i + chunk_size] for i in range(0, len(smiles_list), chunk_size)]
+    # Workers take SMILES from a shared queue, most expensive first, so no process is left with all the slow ones
+    task_queue = make_task_queue(smiles_list, total_processes)
+    # Grammar tables are placed once in shared memory for all processes
+    shm, grammar_handle = share_grammar()
 
     result_queue = multiprocessing.Queue()
     processes = []
 
     # Start worker processes
-    for chunk in chunks:
-        p = multiprocessing.Process(target=process_smiles_worker, args=(chunk, range_, result_queue))
+    for _ in range(total_processes):
+        p = multiprocessing.Process(target=process_smiles_worker, args=(task_queue, range_, result_queue, grammar_handle))
         processes.append(p)
         p.start()
 
@@ -84,6 +90,10 @@ def main():
     for p in processes:
         p.join()
 
+    # Release the shared grammar tables
+    shm.close()
+    shm.unlink()
+
     # Write mismatched SMILES to respective files
     correct_count = 0
     with open(output_less, 'a') as less_file, open(output_more, 'a') as more_file:
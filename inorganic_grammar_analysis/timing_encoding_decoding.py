@@ -1,5 +1,6 @@
 # Script to test the correct process of encoding a SMILES into a gene and decoding it back to a SMILES
 
+import final_results_path
 from cfg_util import *
 from smiles_grammar import GCFG
 from GOs import mutation
@@ -1,3 +1,5 @@
+import bisect
+
 import nltk
 
 import numpy as np
@@ -63,3 +65,126 @@ def decode(rule):
     productions = smiles_grammar.GCFG.productions()
     prod_seq = [productions[i] for i in rule]
     return prods_to_eq(prod_seq)
+
+
+# Default production weights of GrammarSampler (1 for the productions not listed), tuned so that random
+# derivations of GCFG are mostly valid molecules: carbon-rich chains with few branches and multiple bonds.
+# Ring bonds are never sampled (random ring digits almost never match), nor aromatic atoms (they need a ring)
+SEED_WEIGHTS = {
+    "atom -> bracket_atom": 0.02,
+    "atom -> aromatic_organic": 0,
+    "aliphatic_organic -> 'B'": 0.1,
+    "aliphatic_organic -> 'C'": 10,
+    "aliphatic_organic -> 'F'": 0.3,
+    "aliphatic_organic -> 'H'": 0,
+    "aliphatic_organic -> 'I'": 0.1,
+    "aliphatic_organic -> 'N'": 2,
+    "aliphatic_organic -> 'O'": 2,
+    "aliphatic_organic -> 'P'": 0.2,
+    "aliphatic_organic -> 'S'": 0.5,
+    "aliphatic_organic -> 'Cl'": 0.3,
+    "aliphatic_organic -> 'Br'": 0.2,
+    "aliphatic_organic -> 'Si'": 0.1,
+    "aliphatic_organic -> 'Se'": 0.05,
+    "bond -> '='": 0.5,
+    "bond -> '#'": 0.2,
+    "bond -> '/'": 0,
+    "bond -> '\\\\'": 0,
+    "branched_atom -> atom RB": 0,
+    "branched_atom -> atom BB": 0.3,
+    "branched_atom -> atom RB BB": 0,
+    "BB -> BB branch": 0.15,
+    "branch -> '(' bond chain ')'": 0.5,
+}
+
+
+class GrammarSampler:
+    # Random leftmost derivations of a grammar, written directly as genes that gene_to_cfg decodes back to them.
+    # Every nonterminal can be finished with its shortest expansion (fewest productions), so a production is only
+    # taken if what is left open can still be finished within max_rules productions, and past max_depth only
+    # productions of a shortest expansion are taken: every derivation is complete. Among the allowed
+    # alternatives the choice follows the production weights (uniform by default).
+    # The terminals are written out as the derivation goes, so the SMILES of a sample never has to be decoded
+    def __init__(self, cfg=None, weights=None):
+        cfg = cfg if cfg is not None else smiles_grammar.GCFG
+        productions = cfg.productions()
+        if weights is None:
+            weights = [SEED_WEIGHTS.get(str(prod), 1.0) for prod in productions]
+        nonterminals = []
+        for prod in productions:
+            if prod.lhs() not in nonterminals:
+                nonterminals.append(prod.lhs())
+        ids = {symbol: ix for ix, symbol in enumerate(nonterminals)}
+        self.start = ids[productions[0].lhs()]
+        lhs = [ids[prod.lhs()] for prod in productions]
+        # Nonterminals pushed on the stack by every production, reversed as in gene_to_cfg
+        children = [[ids[a] for a in prod.rhs() if isinstance(a, nltk.grammar.Nonterminal) and str(a) != 'None'][::-1]
+                    for prod in productions]
+        # Whole rhs of every production, reversed: nonterminal ids and terminal strings
+        rhs = [[ids[a] if isinstance(a, nltk.grammar.Nonterminal) else a
+                for a in prod.rhs() if str(a) != 'None'][::-1] for prod in productions]
+        alternatives = [[r for r in range(len(productions)) if lhs[r] == n] for n in range(len(nonterminals))]
+
+        # Fewest productions needed to finish every nonterminal
+        min_len = [float('inf')] * len(nonterminals)
+        changed = True
+        while changed:
+            changed = False
+            for r in range(len(productions)):
+                n = 1 + sum(min_len[c] for c in children[r])
+                if n < min_len[lhs[r]]:
+                    min_len[lhs[r]] = n
+                    changed = True
+        self.min_len = min_len
+        # Productions a rule costs on top of the shortest expansion of its lhs
+        extra = [1 + sum(min_len[c] for c in children[r]) - min_len[lhs[r]] for r in range(len(productions))]
+
+        # Alternatives of every nonterminal sorted by extra cost, so the allowed ones are always a prefix.
+        # Per alternative: (gene value, number of alternatives, extra cost, rhs), and the cumulative weights
+        self.options = []
+        self.extras = []
+        self.cum_weights = []
+        for n, rules in enumerate(alternatives):
+            rules = sorted(rules, key=lambda r: extra[r])
+            self.options.append([(alternatives[n].index(r), len(rules), extra[r], rhs[r]) for r in rules])
+            self.extras.append([extra[r] for r in rules])
+            self.cum_weights.append(list(np.cumsum([weights[r] for r in rules])))
+
+    def sample(self, n, gene_size, max_rules=40, max_depth=12, rng=np.random):
+        # (n, gene_size) array of genes, each a complete derivation of at most max_rules productions followed by
+        # random codons, and the list of their SMILES. The defaults are sized to drug-like molecules (a median of
+        # 31 productions and a depth of 10), None means no limit (max_rules is capped by gene_size anyway)
+        max_rules = gene_size if max_rules is None else min(max_rules, gene_size)
+        if self.min_len[self.start] > max_rules:
+            raise ValueError(f'No derivation fits in {max_rules} productions')
+        if max_depth is None:
+            max_depth = max_rules
+        genes = rng.randint(0, 256, size=(n, gene_size))
+        draws = rng.random_sample((n, max_rules))
+        options, extras, cum_weights = self.options, self.extras, self.cum_weights
+        smiles = []
+        for i in range(n):
+            row, u = genes[i], draws[i]
+            tokens = []
+            stack = [(self.start, 0)]
+            pending = self.min_len[self.start]
+            step = 0
+            while stack:
+                item = stack.pop()
+                if isinstance(item, str):
+                    tokens.append(item)
+                    continue
+                symbol, depth = item
+                slack = max_rules - step - pending if depth < max_depth else 0
+                n_allowed = bisect.bisect_right(extras[symbol], slack)
+                cum = cum_weights[symbol]
+                k = bisect.bisect_right(cum, u[step] * cum[n_allowed - 1])
+                choice, n_choices, extra, rhs = options[symbol][min(k, n_allowed - 1)]
+                # Keep the random codon's block of values, so codons stay spread over 0..255
+                codon = row[step] - row[step] % n_choices + choice
+                row[step] = codon if codon < 256 else codon - n_choices
+                pending += extra - 1
+                step += 1
+                stack.extend(a if isinstance(a, str) else (a, depth + 1) for a in rhs)
+            smiles.append(''.join(tokens))
+        return genes, smiles
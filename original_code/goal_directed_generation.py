@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import argparse
 import copy
+import functools
 import json
 import os
 from collections import namedtuple
@@ -19,13 +20,21 @@ from guacamol.goal_directed_generator import GoalDirectedGenerator
 from guacamol.scoring_function import ScoringFunction
 from guacamol.utils.chemistry import canonicalize
 from guacamol.utils.helpers import setup_default_logger
-from . import cfg_util, smiles_grammar
+from . import cfg_util, shared_population, smiles_grammar
+from .molecule_stream import MoleculeStream
+from .pipeline import ChildPipeline
+from .shared_population import SharedPopulation
+from .survivors import SurvivorHeap
+from final_results.smiles_validation import smiles_error
 
 rdBase.DisableLog('rdApp.error')
 GCFG = smiles_grammar.GCFG
 
 Molecule = namedtuple('Molecule', ['score', 'smiles', 'genes'])
 
+# Under a time budget top_k scores the SMILES file in chunks of this size, checking the deadline in between
+TOP_K_CHUNK = 1000
+
 
 def cfg_to_gene(prod_rules, max_len=-1):
     gene = []
@@ -70,118 +79,367 @@ def select_parent(population, tournament_size=3):
     return best
 
 
-def mutation(gene):
-    idx = np.random.choice(len(gene))
+def mutation(gene, rng=np.random):
+    idx = rng.choice(len(gene))
     gene_mutant = copy.deepcopy(gene)
-    gene_mutant[idx] = np.random.randint(0, 256)
+    gene_mutant[idx] = rng.randint(0, 256)
     return gene_mutant
 
 
-def deduplicate(population):
-    unique_smiles = set()
-    unique_population = []
-    for item in population:
-        score, smiles, gene = item
-        if smiles not in unique_smiles:
-            unique_population.append(item)
-        unique_smiles.add(smiles)
-    return unique_population
+def subtree_spans(gene):
+    # lhs of every production used by the gene and the end (exclusive) of the subtree it starts,
+    # computed in one pass over the leftmost derivation. None if the derivation is not complete
+    productions = GCFG.productions()
+    prod_rules = gene_to_cfg(gene)
+    lhs = [productions[r].lhs() for r in prod_rules]
+    parent = []
+    stack = [-1]
+    for pos, r in enumerate(prod_rules):
+        parent.append(stack.pop())
+        n_children = sum(1 for a in productions[r].rhs()
+                         if type(a) == nltk.grammar.Nonterminal and str(a) != 'None')
+        stack.extend([pos] * n_children)
+    if stack:
+        return None
+    end = [pos + 1 for pos in range(len(prod_rules))]
+    for pos in range(len(prod_rules) - 1, 0, -1):
+        end[parent[pos]] = max(end[parent[pos]], end[pos])
+    return lhs, end
+
+
+def crossover(p_gene_a, p_gene_b, rng=np.random):
+    # Replace a random subtree of parent a by a subtree of parent b rooted at the same nonterminal
+    # (a branch, an atom, a ring bond...). Codons inside a subtree only depend on its root symbol,
+    # so the rest of parent a decodes unchanged. The child keeps the length of parent a
+    spans_a, spans_b = subtree_spans(p_gene_a), subtree_spans(p_gene_b)
+    if spans_a is None or spans_b is None:
+        return list(p_gene_a)
+    (lhs_a, end_a), (lhs_b, end_b) = spans_a, spans_b
+    positions_b = {}
+    for j in range(1, len(lhs_b)):
+        positions_b.setdefault(lhs_b[j], []).append(j)
+    candidates = [i for i in range(1, len(lhs_a)) if lhs_a[i] in positions_b]
+    if not candidates:
+        return list(p_gene_a)
+    i = candidates[rng.randint(len(candidates))]
+    options = positions_b[lhs_a[i]]
+    j = options[rng.randint(len(options))]
+    child = list(p_gene_a[:i]) + list(p_gene_b[j:end_b[j]]) + list(p_gene_a[end_a[i]:])
+    if len(child) > len(p_gene_a):
+        return child[:len(p_gene_a)]
+    return child + [rng.randint(0, 256) for _ in range(len(p_gene_a) - len(child))]
+
+
+def task_rng(seed):
+    # RandomState API (randint, choice) on a stream of its own, so the same seed gives the same child in any worker
+    return np.random.RandomState(np.random.PCG64(seed))
+
+
+@functools.lru_cache(maxsize=100000)
+def decode_rules(prod_rules):
+    # Canonical SMILES (None if invalid) of the productions used by a gene. These are the effective form of the
+    # gene: genes differing only in unused tail codons, or in codons picking the same alternative, share them
+    # and are decoded and validated once per worker
+    c_smiles = cfg_util.decode(prod_rules)
+    # Structurally broken SMILES are never parsed by RDKit
+    if c_smiles and smiles_error(c_smiles) is not None:
+        return None
+    return canonicalize(c_smiles)
+
+
+def make_child(p_gene, mate_gene=None, seed=None):
+    # Decoding half of mutate: (canonical SMILES or None if invalid, gene) of a new child,
+    # made by subtree crossover with mate_gene (if given) and a point mutation.
+    # With a seed (a SeedSequence) the child does not depend on the global random state of the worker
+    rng = np.random if seed is None else task_rng(seed)
+    if mate_gene is not None:
+        p_gene = crossover(p_gene, mate_gene, rng)
+    c_gene = mutation(p_gene, rng)
+    return decode_rules(tuple(gene_to_cfg(c_gene))), c_gene
+
+
+def make_shared_child(handle, row, mate_row, seed, out_row):
+    # make_child on the rows of a SharedPopulation: the parents are read from shared memory and the child gene
+    # is written to row out_row of the children, only the SMILES is sent back
+    _, parents, children = shared_population.attach(handle)
+    mate_gene = None if mate_row is None else parents[mate_row].tolist()
+    c_smiles, c_gene = make_child(parents[row].tolist(), mate_gene, seed)
+    children[out_row] = c_gene
+    return c_smiles, None
+
+
+def score_children(children, scoring_function, batch_size=None, pool=None, seen=(), max_scored=None, scored=None):
+    # Scoring half of mutate for a whole generation, through score_list so that scorers can amortise their
+    # setup over a batch. Invalid children get the corrupt score, as score(None) would give them.
+    # Every distinct SMILES is scored once and its score shared by its duplicates, a SMILES already in seen
+    # (the population) is not scored at all, the population never admits those children (as ChildPipeline.run).
+    # Only the first max_scored new SMILES are scored (evaluation budget), the others get the corrupt score.
+    # seen is only read (the survivors' SMILES index, not copied), the scored SMILES are added to scored if given.
+    # With a batch_size the batches are scored in parallel by the joblib pool
+    valid_smiles = list(dict.fromkeys(smiles for smiles, _ in children if smiles is not None and smiles not in seen))
+    valid_smiles = valid_smiles[:max_scored]
+    if scored is not None:
+        scored.update(valid_smiles)
+    if batch_size is None or pool is None:
+        valid_scores = scoring_function.score_list(valid_smiles) if valid_smiles else []
+    else:
+        batches = [valid_smiles[i:i + batch_size] for i in range(0, len(valid_smiles), batch_size)]
+        valid_scores = [score for batch_scores in pool(delayed(scoring_function.score_list)(batch) for batch in batches)
+                        for score in batch_scores]
+    scores = dict(zip(valid_smiles, valid_scores))
+    scores = [scores.get(smiles, scoring_function.corrupt_score) for smiles, _ in children]
+    return [Molecule(score, smiles, gene) for score, (smiles, gene) in zip(scores, children)]
 
 
 def mutate(p_gene, scoring_function):
-    c_gene = mutation(p_gene)
-    c_smiles = canonicalize(cfg_util.decode(gene_to_cfg(c_gene)))
-    c_score = scoring_function.score(c_smiles)
-    return Molecule(c_score, c_smiles, c_gene)
+    return score_children([make_child(p_gene)], scoring_function)[0]
 
 
 class ChemGEGenerator(GoalDirectedGenerator):
 
-    def __init__(self, smi_file, population_size, n_mutations, gene_size, generations, n_jobs=-1, random_start=False, patience=5):
+    def __init__(self, smi_file, population_size, n_mutations, gene_size, generations, n_jobs=-1, random_start=False, patience=5,
+                 crossover_rate=0.0, score_batch_size=None, decode_jobs=None, score_jobs=1, queue_size=64, seed=None,
+                 grammar_start=False, max_rules=40, max_depth=12, time_budget=None, max_evaluations=None, export_file=None):
         self.pool = joblib.Parallel(n_jobs=n_jobs)
         self.smi_file = smi_file
-        self.all_smiles = self.load_smiles_from_file(self.smi_file)
+        # With grammar_start the initial population is sampled from the grammar and no SMILES file is needed
+        self.grammar_start = grammar_start
+        self.max_rules = max_rules
+        self.max_depth = max_depth
+        self.sampler = cfg_util.GrammarSampler() if grammar_start else None
+        self.all_smiles = self.load_smiles_from_file(self.smi_file) if not grammar_start else []
         self.population_size = population_size
         self.n_mutations = n_mutations
         self.gene_size = gene_size
         self.generations = generations
         self.random_start = random_start
         self.patience = patience
+        # Fraction of the children made by subtree crossover with a second parent before mutating
+        self.crossover_rate = crossover_rate
+        # Children are scored with score_list, in parallel batches of this size (None: one batch)
+        self.score_batch_size = score_batch_size
+        # With decode_jobs, children go through a two-stage pipeline instead of the joblib pool:
+        # decode_jobs workers decode and validate them, score_jobs workers score the new ones
+        self.decode_jobs = decode_jobs
+        self.score_jobs = score_jobs
+        self.queue_size = queue_size
+        # Entropy of the per-child random streams, drawn from the global random state if None
+        self.seed = seed
+        # Budgets of every generate_optimized_molecules call: wall-clock seconds and scored molecules
+        # (the initial population included, the SMILES file ranked by top_k excluded). The time budget covers
+        # the ranking of the SMILES file, which stops at the deadline. Generations are shrunk to fit what is
+        # left, and the population reached so far is returned when either runs out
+        self.time_budget = time_budget
+        self.max_evaluations = max_evaluations
+        # The molecules admitted to the population are appended to export_file as the run goes (see MoleculeStream)
+        self.export_file = export_file
+        self.n_runs = 0
 
     def load_smiles_from_file(self, smi_file):
         with open(smi_file) as f:
             return self.pool(delayed(canonicalize)(s.strip()) for s in f)
 
-    def top_k(self, smiles, scoring_function, k):
-        joblist = (delayed(scoring_function.score)(s) for s in smiles)
-        scores = self.pool(joblist)
-        scored_smiles = list(zip(scores, smiles))
+    def sample_population(self, size, max_samples=None):
+        # size distinct valid molecules sampled from the grammar, as (canonical SMILES, genes). Derivations are
+        # drawn in batches of size, a ValueError is raised as soon as a batch brings no new molecule or
+        # max_samples derivations (default 20 * size) do not fill the population
+        max_samples = 20 * size if max_samples is None else max_samples
+        smiles, genes = [], []
+        seen = set()
+        n_sampled = 0
+        t0 = time()
+        while len(smiles) < size:
+            if n_sampled >= max_samples:
+                raise ValueError(f'Only {len(smiles)} of {size} valid molecules in {n_sampled} grammar samples')
+            batch_genes, batch_smiles = self.sampler.sample(size, self.gene_size, self.max_rules, self.max_depth)
+            n_sampled += size
+            n_before = len(smiles)
+            for gene, s in zip(batch_genes.tolist(), batch_smiles):
+                if smiles_error(s) is not None:
+                    continue
+                s = canonicalize(s)
+                if s is None or '%' in s or s in seen:
+                    continue
+                seen.add(s)
+                smiles.append(s)
+                genes.append(gene)
+                if len(smiles) == size:
+                    break
+            if len(smiles) == n_before:
+                raise ValueError(f'No new valid molecule in {size} grammar samples ({len(smiles)} of {size} found)')
+        print(f'{size} seeds from {n_sampled} grammar samples ({size / (time() - t0):.0f} valid seeds/sec)')
+        return smiles, genes
+
+    def top_k(self, smiles, scoring_function, k, deadline=None):
+        # With a deadline, scoring stops once it has passed and at least k molecules were scored,
+        # and only the molecules scored so far are ranked
+        chunk_size = len(smiles) if deadline is None else TOP_K_CHUNK
+        scored_smiles = []
+        for start in range(0, len(smiles), max(chunk_size, 1)):
+            if deadline is not None and time() >= deadline and len(scored_smiles) >= k:
+                print(f'Time budget reached after ranking {len(scored_smiles)} of {len(smiles)} molecules')
+                break
+            chunk = smiles[start:start + chunk_size]
+            scores = self.pool(delayed(scoring_function.score)(s) for s in chunk)
+            scored_smiles += zip(scores, chunk)
         scored_smiles = sorted(scored_smiles, key=lambda x: x[0], reverse=True)
         return [smile for score, smile in scored_smiles][:k]
 
+    def generation_size(self, deadline, evaluations, child_time, child_evaluations):
+        # Number of children of the next generation within the budgets (0 when they are spent), estimated
+        # from the time and the evaluations per child of the previous generation (the scoring time per molecule
+        # of the initial population for the first one)
+        n_children = self.n_mutations
+        if deadline is not None:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return 0
+            if child_time:
+                n_children = min(n_children, int(remaining / child_time))
+        if self.max_evaluations is not None:
+            remaining = self.max_evaluations - evaluations
+            if remaining <= 0:
+                return 0
+            # Scoring stops at the budget anyway, this only avoids decoding children that would not be scored
+            if child_evaluations:
+                n_children = min(n_children, int(np.ceil(remaining / child_evaluations)))
+        return n_children
+
     def generate_optimized_molecules(self, scoring_function: ScoringFunction, number_molecules: int,
                                      starting_population: Optional[List[str]] = None) -> List[str]:
+        deadline = time() + self.time_budget if self.time_budget is not None else None
 
         if number_molecules > self.population_size:
             self.population_size = number_molecules
             print(f'Benchmark requested more molecules than expected: new population is {number_molecules}')
 
         # fetch initial population?
+        initial_genes = None
         if starting_population is None:
             print('selecting initial population...')
             init_size = self.population_size + self.n_mutations
-            all_smiles = copy.deepcopy(self.all_smiles)
-            if self.random_start:
-                starting_population = np.random.choice(all_smiles, init_size)
+            if self.grammar_start:
+                # Sampled seeds come with their genes, they are never parsed
+                starting_population, initial_genes = self.sample_population(init_size)
             else:
-                starting_population = self.top_k(all_smiles, scoring_function, init_size)
+                all_smiles = copy.deepcopy(self.all_smiles)
+                if self.random_start:
+                    starting_population = np.random.choice(all_smiles, init_size)
+                else:
+                    starting_population = self.top_k(all_smiles, scoring_function, init_size, deadline)
 
-        # The smiles GA cannot deal with '%' in SMILES strings (used for two-digit ring numbers).
-        starting_population = [smiles for smiles in starting_population if '%' not in smiles]
+        if initial_genes is None:
+            # The smiles GA cannot deal with '%' in SMILES strings (used for two-digit ring numbers).
+            starting_population = [smiles for smiles in starting_population if '%' not in smiles]
 
-        # calculate initial genes
-        initial_genes = [cfg_to_gene(cfg_util.encode(s), max_len=self.gene_size)
-                         for s in starting_population]
+            # calculate initial genes
+            initial_genes = [cfg_to_gene(cfg_util.encode(s), max_len=self.gene_size)
+                             for s in starting_population]
 
-        # score initial population
+        # score initial population, its time per molecule sizes the first generation under a time budget
+        t0 = time()
         initial_scores = scoring_function.score_list(starting_population)
+        child_time = (time() - t0) / len(starting_population) if len(starting_population) else None
         population = [Molecule(*m) for m in zip(initial_scores, starting_population, initial_genes)]
         population = sorted(population, key=lambda x: x.score, reverse=True)[:self.population_size]
-        population_scores = [p.score for p in population]
+
+        # Every child gets its own stream, spawned per generation and per child index, so the run is the same
+        # whatever the number of workers
+        seed = self.seed if self.seed is not None else np.random.randint(2 ** 31)
+        seed_sequence = np.random.SeedSequence(seed)
 
         # evolution: go go go!!
-        t0 = time()
+        # Parent and child genes are exchanged with the workers through shared memory
+        buffers = SharedPopulation(self.population_size, self.n_mutations, self.gene_size)
+        pipeline = None
+        stream = MoleculeStream(self.export_file) if self.export_file is not None else None
+        try:
+            if self.decode_jobs:
+                pipeline = ChildPipeline(make_shared_child, scoring_function, self.decode_jobs, self.score_jobs,
+                                         self.score_batch_size or 16, self.queue_size)
+            population = self.evolve(population, scoring_function, seed_sequence, buffers, pipeline, deadline,
+                                     len(starting_population), stream, child_time)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+            buffers.close()
+            if stream is not None:
+                stream.close()
+            self.n_runs += 1
 
+        # finally
+        return [molecule.smiles for molecule in population[:number_molecules]]
+
+    def evolve(self, population, scoring_function, seed_sequence, buffers, pipeline=None, deadline=None,
+               evaluations=0, stream=None, child_time=None):
+        # The population keeps its rows in the shared buffers, admitted children take the rows of the molecules
+        # they replace
+        survivors = SurvivorHeap(self.population_size)
+        for molecule in population:
+            survivors.offer(molecule)
+        population = survivors.molecules
+        buffers.store(population)
+        if stream is not None:
+            stream.write(self.n_runs, -1, survivors.ranked())
+        t0 = time()
         patience = 0
+        # child_time starts from an estimate (the initial scoring) until a generation has been timed
+        child_evaluations = None
 
+        generation_seeds = seed_sequence.spawn(self.generations)
         for generation in range(self.generations):
 
-            old_scores = population_scores
-            # select random genes
-            all_genes = [molecule.genes for molecule in population]
-            choice_indices = np.random.choice(len(all_genes), self.n_mutations, replace=True)
-            genes_to_mutate = [all_genes[i] for i in choice_indices]
-
-            # evolve genes
-            joblist = (delayed(mutate)(g, scoring_function) for g in genes_to_mutate)
-            new_population = self.pool(joblist)
-
-            # join and dedup
-            population += new_population
-            population = deduplicate(population)
-
-            # survival of the fittest
-            population = sorted(population, key=lambda x: x.score, reverse=True)[:self.population_size]
+            n_children = self.generation_size(deadline, evaluations, child_time, child_evaluations)
+            if n_children <= 0:
+                print(f'Budget spent after {generation} generations ({evaluations} evaluations)')
+                break
+
+            # select random genes: tasks only carry the rows of the parents in the shared buffers
+            choice_indices = np.random.choice(len(population), n_children, replace=True)
+
+            # evolve genes: children are decoded in parallel, then scored in batches
+            child_seeds = generation_seeds[generation].spawn(n_children)
+            if self.crossover_rate > 0:
+                mate_indices = np.random.choice(len(population), n_children, replace=True)
+                use_crossover = np.random.random_sample(n_children) < self.crossover_rate
+                tasks = [(buffers.handle, i, m if c else None, s, k)
+                         for k, (i, m, c, s) in enumerate(zip(choice_indices, mate_indices, use_crossover, child_seeds))]
+            else:
+                tasks = [(buffers.handle, i, None, s, k) for k, (i, s) in enumerate(zip(choice_indices, child_seeds))]
+            max_scored = self.max_evaluations - evaluations if self.max_evaluations is not None else None
+            # New SMILES scored in this generation, both paths score the first max_scored of them
+            scored_smiles = set()
+            if pipeline is not None:
+                scored = pipeline.run(tasks, survivors.rows, max_scored, scored_smiles)
+                new_population = [Molecule(score, smiles, gene)
+                                  for (score, smiles, _), gene in zip(scored, buffers.child_genes(len(tasks)))]
+            else:
+                children = self.pool(delayed(make_shared_child)(*task) for task in tasks)
+                children = [(smiles, gene) for (smiles, _), gene in zip(children, buffers.child_genes(len(tasks)))]
+                new_population = score_children(children, scoring_function, self.score_batch_size, self.pool,
+                                                survivors.rows, max_scored, scored_smiles)
+            n_scored = len(scored_smiles)
+            evaluations += n_scored
+
+            # survival of the fittest: new children beating the worst molecule replace it
+            admitted = {survivors.offer(molecule) for molecule in new_population} - {None}
+            for row in admitted:
+                buffers.store_row(row, population[row])
+            if stream is not None:
+                stream.write(self.n_runs, generation,
+                             sorted((population[row] for row in admitted), key=lambda x: x.score, reverse=True))
 
             # stats
             gen_time = time() - t0
-            mol_sec = (self.population_size + self.n_mutations) / gen_time
+            mol_sec = (self.population_size + n_children) / gen_time
             t0 = time()
+            child_time = gen_time / n_children
+            child_evaluations = n_scored / n_children
 
-            population_scores = [p.score for p in population]
+            population_scores = survivors.scores()
 
             # early stopping
-            if population_scores == old_scores:
+            if not admitted:
                 patience += 1
                 print(f'Failed to progress: {patience}')
                 if patience >= self.patience:
@@ -198,8 +456,7 @@ class ChemGEGenerator(GoalDirectedGenerator):
                   f'{gen_time:.2f} sec/gen | '
                   f'{mol_sec:.2f} mol/sec')
 
-        # finally
-        return [molecule.smiles for molecule in population[:number_molecules]]
+        return survivors.ranked()
 
 
 def main():
@@ -212,8 +469,19 @@ def main():
     parser.add_argument('--generations', type=int, default=1000)
     parser.add_argument('--n_jobs', type=int, default=-1)
     parser.add_argument('--random_start', action='store_true')
+    parser.add_argument('--grammar_start', action='store_true')
+    parser.add_argument('--max_rules', type=int, default=40)
+    parser.add_argument('--max_depth', type=int, default=12)
     parser.add_argument('--output_dir', type=str, default=None)
     parser.add_argument('--patience', type=int, default=5)
+    parser.add_argument('--crossover_rate', type=float, default=0.0)
+    parser.add_argument('--score_batch_size', type=int, default=None)
+    parser.add_argument('--decode_jobs', type=int, default=None)
+    parser.add_argument('--score_jobs', type=int, default=1)
+    parser.add_argument('--queue_size', type=int, default=64)
+    parser.add_argument('--time_budget', type=float, default=None)
+    parser.add_argument('--max_evaluations', type=int, default=None)
+    parser.add_argument('--export_file', type=str, default=None)
     parser.add_argument('--suite', default='v2')
 
     args = parser.parse_args()
@@ -236,7 +504,18 @@ def main():
                                 generations=args.generations,
                                 n_jobs=args.n_jobs,
                                 random_start=args.random_start,
-                                patience=args.patience)
+                                grammar_start=args.grammar_start,
+                                max_rules=args.max_rules,
+                                max_depth=args.max_depth,
+                                patience=args.patience,
+                                crossover_rate=args.crossover_rate,
+                                score_batch_size=args.score_batch_size,
+                                decode_jobs=args.decode_jobs,
+                                score_jobs=args.score_jobs,
+                                queue_size=args.queue_size,
+                                time_budget=args.time_budget,
+                                max_evaluations=args.max_evaluations,
+                                export_file=args.export_file)
 
     json_file_path = os.path.join(args.output_dir, 'goal_directed_results.json')
     assess_goal_directed_generation(optimiser, json_output_file=json_file_path, benchmark_version=args.suite)
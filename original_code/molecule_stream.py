@@ -0,0 +1,49 @@
+# Append-only export of the molecules admitted to the population while a run is going on, so that downstream
+# jobs (docking, DFT...) can start on early results. Every admitted molecule is one tab-separated line
+#   run  generation  score  smiles  gene
+# run counts the generate_optimized_molecules calls of a generator, generation is -1 for the initial population,
+# and the gene is written as hex (one byte per codon). Lines are handed to a writer thread, so the generation
+# loop never waits for the disk, and flushed once per generation.
+import queue
+import threading
+
+
+def molecule_line(run, generation, molecule):
+    return f'{run}\t{generation}\t{molecule.score}\t{molecule.smiles}\t{bytes(molecule.genes).hex()}\n'
+
+
+class MoleculeStream:
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue()
+        self.error = None
+        self.writer = threading.Thread(target=self.write_lines, daemon=True)
+        self.writer.start()
+
+    def write_lines(self):
+        try:
+            with open(self.path, 'a') as f:
+                while True:
+                    lines = self.queue.get()
+                    if lines is None:
+                        break
+                    f.writelines(lines)
+                    f.flush()
+        except OSError as e:
+            # Reported by close(), the run itself goes on
+            self.error = e
+
+    def write(self, run, generation, molecules):
+        # Invalid molecules (no SMILES) are not exported
+        lines = [molecule_line(run, generation, molecule) for molecule in molecules if molecule.smiles is not None]
+        if lines and self.error is None:
+            self.queue.put(lines)
+
+    def close(self):
+        # An export error is only reported: close() runs in the finally of a run, raising there would throw away
+        # the population of a finished run or hide the exception of a failed one
+        self.queue.put(None)
+        self.writer.join()
+        if self.error is not None:
+            print(f'Warning: export to {self.path} stopped: {self.error}')
@@ -0,0 +1,143 @@
+# Two-stage pipeline producing the children of a generation.
+# Decoding workers turn parent genes into (smiles, gene) children while scoring workers consume them in batches
+# through score_list. The stages are connected by bounded queues, so a slow stage makes the other one wait
+# (backpressure) instead of piling up children in memory, and each stage is sized separately so that cheap
+# decoding keeps running while an expensive scorer is busy.
+# The workers live as long as the pipeline, i.e. for a whole optimisation run, not a single generation.
+# An exception in a worker is sent back as (None, traceback) and raised by run(), which also stops waiting
+# when a worker died without a word.
+import multiprocessing
+import queue
+import threading
+import traceback
+
+# Seconds between checks that the workers are still alive while waiting for their results
+POLL_INTERVAL = 1.0
+
+
+def decode_worker(make_child, task_queue, child_queue):
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        index, args = task
+        try:
+            child_queue.put((index, make_child(*args)))
+        except Exception:
+            child_queue.put((None, traceback.format_exc()))
+
+
+def score_worker(scoring_function, batch_queue, score_queue):
+    while True:
+        batch = batch_queue.get()
+        if batch is None:
+            break
+        indices, smiles = batch
+        try:
+            score_queue.put((indices, scoring_function.score_list(smiles)))
+        except Exception:
+            score_queue.put((None, traceback.format_exc()))
+
+
+class ChildPipeline:
+
+    def __init__(self, make_child, scoring_function, n_decode_workers, n_score_workers, batch_size=16,
+                 queue_size=64):
+        self.batch_size = batch_size
+        self.corrupt_score = scoring_function.corrupt_score
+        self.task_queue = multiprocessing.Queue(queue_size)
+        self.child_queue = multiprocessing.Queue(queue_size)
+        self.batch_queue = multiprocessing.Queue(max(1, queue_size // batch_size))
+        # Never bounded: scoring workers must always be able to hand back their results
+        self.score_queue = multiprocessing.Queue()
+        self.decode_workers = [multiprocessing.Process(target=decode_worker, daemon=True,
+                                                       args=(make_child, self.task_queue, self.child_queue))
+                               for _ in range(n_decode_workers)]
+        self.score_workers = [multiprocessing.Process(target=score_worker, daemon=True,
+                                                      args=(scoring_function, self.batch_queue, self.score_queue))
+                              for _ in range(n_score_workers)]
+        for worker in self.decode_workers + self.score_workers:
+            worker.start()
+        self.failed = False
+
+    def get(self, result_queue):
+        # Next result of a worker, raises if a worker failed or died
+        while True:
+            try:
+                key, value = result_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.decode_workers + self.score_workers):
+                    self.failed = True
+                    raise RuntimeError('A pipeline worker died')
+                continue
+            if key is None:
+                self.failed = True
+                raise RuntimeError(f'A pipeline worker failed:\n{value}')
+            return key, value
+
+    def feed(self, tasks):
+        for index, args in enumerate(tasks):
+            self.task_queue.put((index, args))
+
+    def run(self, tasks, seen=(), max_scored=None, scored=None):
+        # tasks are the argument tuples of make_child. Returns the children as (score, smiles, gene) in task order.
+        # Children are deduplicated in task order before scoring: a SMILES already in seen (the population) or
+        # produced by an earlier child is not scored again, the population never admits those children.
+        # Only the first max_scored new SMILES are scored (evaluation budget). seen is only read (the survivors'
+        # SMILES index, not copied), the scored SMILES are added to scored if given.
+        # Invalid and unscored children get the corrupt score
+        feeder = threading.Thread(target=self.feed, args=(tasks,), daemon=True)
+        feeder.start()
+
+        n = len(tasks)
+        children = [None] * n
+        scores = [self.corrupt_score] * n
+        if scored is None:
+            scored = set()
+        # Children arrive in any order, they are released in task order so deduplication is deterministic
+        arrived = {}
+        next_index = 0
+        indices, batch = [], []
+        n_batches = 0
+        for _ in range(n):
+            index, child = self.get(self.child_queue)
+            arrived[index] = child
+            while next_index in arrived:
+                smiles, gene = children[next_index] = arrived.pop(next_index)
+                if (smiles is not None and smiles not in seen and smiles not in scored
+                        and (max_scored is None or len(scored) < max_scored)):
+                    scored.add(smiles)
+                    indices.append(next_index)
+                    batch.append(smiles)
+                    if len(batch) == self.batch_size:
+                        self.batch_queue.put((indices, batch))
+                        n_batches += 1
+                        indices, batch = [], []
+                next_index += 1
+        if batch:
+            self.batch_queue.put((indices, batch))
+            n_batches += 1
+        feeder.join()
+
+        for _ in range(n_batches):
+            batch_indices, batch_scores = self.get(self.score_queue)
+            for index, score in zip(batch_indices, batch_scores):
+                scores[index] = score
+        return [(score, smiles, gene) for score, (smiles, gene) in zip(scores, children)]
+
+    def close(self):
+        if self.failed:
+            # Tasks and results of the failed run are still queued, the workers cannot be drained
+            for worker in self.decode_workers + self.score_workers:
+                worker.terminate()
+                worker.join()
+            # Nobody reads these queues any more, do not wait for them to be flushed at exit
+            for q in (self.task_queue, self.batch_queue):
+                q.cancel_join_thread()
+            return
+        for _ in self.decode_workers:
+            self.task_queue.put(None)
+        for _ in self.score_workers:
+            self.batch_queue.put(None)
+        for worker in self.decode_workers + self.score_workers:
+            worker.join()
@@ -0,0 +1,71 @@
+# Population buffers in shared memory, so that parallel workers read the parent genes and write their children
+# in place instead of pickling genes with every task and every result. Genes have a fixed length (gene_size)
+# and codons fit in a byte, so a run needs a single block holding
+#   scores    (population_size,) float64           scores of the current population
+#   parents   (population_size, gene_size) uint8   genes of the current population, one row per molecule
+#   children  (n_mutations, gene_size) uint8       genes of the new children, one row per task
+# Tasks only carry row indices and the small handle of the block.
+import sys
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Arrays of the blocks used by this process, by block name
+_attached = {}
+
+
+def views(buf, population_size, n_mutations, gene_size):
+    scores = np.ndarray((population_size,), dtype=np.float64, buffer=buf)
+    offset = scores.nbytes
+    parents = np.ndarray((population_size, gene_size), dtype=np.uint8, buffer=buf, offset=offset)
+    offset += parents.nbytes
+    children = np.ndarray((n_mutations, gene_size), dtype=np.uint8, buffer=buf, offset=offset)
+    return scores, parents, children
+
+
+class SharedPopulation:
+
+    def __init__(self, population_size, n_mutations, gene_size):
+        nbytes = population_size * 8 + (population_size + n_mutations) * gene_size
+        self.shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        # Small and picklable, passed to the workers with every task
+        self.handle = (self.shm.name, population_size, n_mutations, gene_size)
+        self.scores, self.parents, self.children = views(self.shm.buf, population_size, n_mutations, gene_size)
+        # Tasks run in this process (n_jobs=1) use the arrays directly
+        _attached[self.shm.name] = (None, self.scores, self.parents, self.children)
+
+    def store(self, population):
+        # Rows follow the order of the population list
+        for row, molecule in enumerate(population):
+            self.store_row(row, molecule)
+
+    def store_row(self, row, molecule):
+        self.scores[row] = molecule.score
+        self.parents[row] = molecule.genes
+
+    def child_genes(self, n):
+        return self.children[:n].tolist()
+
+    def close(self):
+        _attached.pop(self.shm.name, None)
+        # The views must be released before the mapping can be closed
+        del self.scores, self.parents, self.children
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(handle):
+    # (scores, parents, children) of the block created by a SharedPopulation, mapped once per process
+    name = handle[0]
+    if name not in _attached:
+        # A worker only serves one run at a time, release the blocks of earlier runs
+        for old in [old for old, (shm, *_) in _attached.items() if shm is not None]:
+            shm = _attached.pop(old)[0]
+            shm.close()
+        if sys.version_info >= (3, 13):
+            # Only the creating process owns (and unlinks) the block
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+        _attached[name] = (shm,) + views(shm.buf, *handle[1:])
+    return _attached[name][1:]
@@ -1,5 +1,3 @@
-import nltk
-
 # smiles grammar
 gram = """smiles -> chain
 atom -> bracket_atom
@@ -85,4 +83,11 @@ chain -> chain bond branched_atom
 Nothing -> None"""
 
 # form the CFG and get the start symbol
-GCFG = nltk.CFG.fromstring(gram)
+# GCFG is built on first access, so that reading the grammar string does not import nltk
+def __getattr__(name):
+    if name == 'GCFG':
+        import nltk
+        global GCFG
+        GCFG = nltk.CFG.fromstring(gram)
+        return GCFG
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
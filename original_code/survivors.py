@@ -0,0 +1,49 @@
+# Survival of the fittest without re-sorting the population every generation.
+# The population is a bounded min-heap on the scores with an index of its SMILES: a child is only admitted if
+# its SMILES is new and it beats the worst molecule, which it then replaces. The cost of a generation scales
+# with the number of children that improve the population instead of (population + children) log(...).
+# Every molecule keeps the row it was admitted in (its row in the shared population buffers), so only the rows
+# of admitted children have to be rewritten. Among equal scores the molecule admitted first ranks higher,
+# as with a stable sort of the population followed by its children.
+import heapq
+
+
+class SurvivorHeap:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Molecules by row
+        self.molecules = []
+        # Row of every SMILES in the population
+        self.rows = {}
+        # (score, -admission number, row), the worst molecule on top
+        self.heap = []
+        self.n_admitted = 0
+
+    def __len__(self):
+        return len(self.molecules)
+
+    def offer(self, molecule):
+        # Row taken by the molecule, or None if it is a duplicate or not better than the worst one
+        if molecule.smiles in self.rows:
+            return None
+        if len(self.molecules) < self.capacity:
+            row = len(self.molecules)
+            self.molecules.append(molecule)
+        elif self.heap and molecule.score > self.heap[0][0]:
+            row = heapq.heappop(self.heap)[2]
+            del self.rows[self.molecules[row].smiles]
+            self.molecules[row] = molecule
+        else:
+            return None
+        self.rows[molecule.smiles] = row
+        heapq.heappush(self.heap, (molecule.score, -self.n_admitted, row))
+        self.n_admitted += 1
+        return row
+
+    def scores(self):
+        return [molecule.score for molecule in self.molecules]
+
+    def ranked(self):
+        # Molecules from best to worst
+        return [self.molecules[row] for _, _, row in sorted(self.heap, reverse=True)]